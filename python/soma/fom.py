@@ -144,6 +144,7 @@ At lower level, they are used through several classes:
 * :class:`FileOrganizationModels` represents a FOM rules set.
 * :class:`AttributesToPaths` is used to convert a set of attributes into filenames (which is the main use of FOMs).
 * :class:`PathToAttributes` performs the reverse operation: match attributes and determines their values from a given filename.
+* :class:`MultiPathToAttributes` does the same for several FOMs at once.
 
 '''
 
@@ -152,18 +153,26 @@ import os
 import os.path as osp
 import stat
 import time
+import errno
 import re
 import pprint
 import sqlite3
 import json
+import hashlib
+import binascii
+import tempfile
+import itertools
+import threading
+import operator
 import six
 from six.moves import range
+from six.moves import queue
 try:
     import bz2
 except ImportError:
     bz2 = None
 
-from collections import OrderedDict
+from collections import OrderedDict, Counter
 
 
 try:
@@ -229,14 +238,155 @@ def read_json(file_name):
                          (file_name, str(e), extra_msg))
 
 
+def _freeze(value):
+    '''
+    Hashable equivalent of a value made of dicts, lists, tuples and sets.
+    Types are kept, so that equal values of different types (1, 1.0 and
+    True) give different keys.
+    '''
+    if isinstance(value, dict):
+        return frozenset((_freeze(k), _freeze(v))
+                         for k, v in six.iteritems(value))
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(_freeze(i) for i in value))
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_freeze(i) for i in value)
+    hash(value)
+    return (type(value), value)
+
+
+class _LRUCache(object):
+
+    '''
+    Bounded mapping keeping the most recently used items, with hit and miss
+    counters. A maxsize of None means an unbounded cache.
+    '''
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.maxsize == 0:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if self.maxsize is not None and len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._data), 'maxsize': self.maxsize}
+
+
+class LazyStat(object):
+
+    '''
+    Stat tuple of a directory entry listed with :func:`os.scandir`. The file
+    type is known from the directory listing, the full stat tuple is only
+    fetched from the filesystem when a value is actually read. It otherwise
+    behaves as the tuple of a :func:`os.stat` result (and is pickled as
+    such).
+    '''
+
+    __slots__ = ('_entry', '_st')
+
+    def __init__(self, entry):
+        self._entry = entry
+        self._st = None
+
+    def is_dir(self):
+        return self._entry.is_dir()
+
+    def _stat(self):
+        if self._st is None:
+            self._st = tuple(self._entry.stat())
+        return self._st
+
+    def __getitem__(self, index):
+        return self._stat()[index]
+
+    def __len__(self):
+        return len(self._stat())
+
+    def __iter__(self):
+        return iter(self._stat())
+
+    def __eq__(self, other):
+        if isinstance(other, LazyStat):
+            other = other._stat()
+        return self._stat() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._stat())
+
+    def __reduce__(self):
+        return (tuple, (self._stat(), ))
+
+    def __repr__(self):
+        if self._st is None:
+            return '<LazyStat( %s )>' % repr(self._entry.path)
+        return repr(self._st)
+
+
+def _stat_key(st):
+    '''
+    Values of a stat tuple compared to detect file changes (mode, size and
+    mtime), or None.
+    '''
+    if st is None:
+        return None
+    return (int(st[stat.ST_MODE]), int(st[stat.ST_SIZE]),
+            int(st[stat.ST_MTIME]))
+
+
+def _is_directory(st):
+    if isinstance(st, LazyStat):
+        return st.is_dir()
+    return stat.S_ISDIR(st[0])
+
+
 class DirectoryAsDict(object):
 
     def __new__(cls, directory, cache=None):
         if osp.isdir(directory):
-            return super(DirectoryAsDict, cls).__new__(cls, directory, cache)
+            return super(DirectoryAsDict, cls).__new__(cls)
+        elif DirectoryTree.is_tree_file(directory):
+            directories = DirectoryTree.load(directory).directories()
+            if len(directories) == 1:
+                return list(directories.values())[0][1]
+            return directories
         else:
             with open(directory) as f:
-                return json.load(f)
+                data = json.load(f)
+            if isinstance(data, dict) \
+                    and data.get('format') == DirectoriesCache.json_format:
+                directories = data['directories']
+                if len(directories) == 1:
+                    return list(directories.values())[0][1]
+                return directories
+            return data
 
     def __init__(self, directory, cache=None):
         self.directory = directory
@@ -245,10 +395,24 @@ class DirectoryAsDict(object):
         else:
             self.cache = cache
 
+    @classmethod
+    def _subdirectory(cls, directory, cache):
+        # directory is known to be a directory: skip the check of __new__
+        result = super(DirectoryAsDict, cls).__new__(cls)
+        result.directory = directory
+        result.cache = cache
+        return result
+
     def __repr__(self):
         return '<DirectoryAsDict( %s )>' % repr(self.directory)
 
     def iteritems(self):
+        '''
+        Iterate over (name, [st, content]) items of the directory. st is a
+        :class:`LazyStat`: listing a directory only needs the file types
+        returned by :func:`os.scandir`, the stat of an entry is done when it
+        is read.
+        '''
         st_content = self.cache.get_directory(self.directory)
         if st_content is not None:
             st, content = st_content
@@ -256,61 +420,78 @@ class DirectoryAsDict(object):
                 yield i
         else:
             try:
-                listdir = os.listdir(self.directory)
+                entries = os.scandir(self.directory)
             except OSError:
                 yield '', [None, None]
                 return
-            for name in listdir:
-                full_path = osp.join(self.directory, name)
-                st_content = self.cache.get_directory(full_path)
-                if st_content is not None:
-                    yield st_content
-                else:
-                    st = os.stat(full_path)
-                    if stat.S_ISDIR(st.st_mode):
-                        yield (name, [tuple(st), DirectoryAsDict(full_path)])
+            with entries:
+                for entry in entries:
+                    st_content = self.cache.get_directory(entry.path)
+                    if st_content is not None:
+                        yield (entry.name, st_content)
+                    elif entry.is_dir():
+                        yield (entry.name,
+                               [LazyStat(entry),
+                                self._subdirectory(entry.path, self.cache)])
                     else:
-                        yield (name, [tuple(st), None])
+                        yield (entry.name, [LazyStat(entry), None])
+
+    def items(self):
+        return self.iteritems()
 
     @staticmethod
-    def get_directory(directory, debug=None):
+    def get_directory(directory, debug=None, with_stat=True):
+        '''
+        Read the whole directory tree as nested dicts: {name: [st, content]}
+        where st is the lstat tuple of an entry, and content is a dict for
+        directories and None for other entries.
+
+        If with_stat is False, no stat is done at all (st is None, and file
+        sizes are not counted in debug messages): entries types come from
+        the directory listing, which is enough for FOM matching.
+        '''
         return DirectoryAsDict._get_directory(
-            directory, debug, 0, 0, 0, 0, 0, 0, 0)[0]
+            directory, debug, 0, 0, 0, 0, 0, 0, 0, with_stat)[0]
 
     @staticmethod
     def _get_directory(directory, debug, directories, files, links,
-                       files_size, path_size, errors, count):
+                       files_size, path_size, errors, count, with_stat=True):
         try:
-            listdir = os.listdir(directory)
+            entries = os.scandir(directory)
             result = {}
         except OSError:
             errors += 1
             result = None
         if result is not None:
-            for name in listdir:
-                if debug and count % 100 == 0:
-                    debug.info('%s files=%d, directories=%d, size=%d'
-                               % (time.asctime(), files + links, directories,
-                                  files_size))
-                path_size += len(name)
-                count += 1
-                full_path = osp.join(directory, name)
-                st = os.lstat(full_path)
-                if stat.S_ISREG(st.st_mode):
-                    files += 1
-                    files_size += st.st_size
-                    result[name] = [tuple(st), None]
-                elif stat.S_ISDIR(st.st_mode):
-                    content, directories, files, links, files_size, \
-                        path_size, errors, count =  \
-                        DirectoryAsDict._get_directory(full_path, debug,
-                                                       directories +
-                                                       1, files, links, files_size,
-                                                       path_size, errors, count)
-                    result[name] = [tuple(st), content]
-                else:
-                    links += 1
-                    result[name] = [tuple(st), None]
+            with entries:
+                for entry in entries:
+                    name = entry.name
+                    if debug and count % 100 == 0:
+                        debug.info('%s files=%d, directories=%d, size=%d'
+                                   % (time.asctime(), files + links,
+                                      directories, files_size))
+                    path_size += len(name)
+                    count += 1
+                    if with_stat:
+                        st = tuple(entry.stat(follow_symlinks=False))
+                    else:
+                        st = None
+                    if entry.is_file(follow_symlinks=False):
+                        files += 1
+                        if st is not None:
+                            files_size += st[stat.ST_SIZE]
+                        result[name] = [st, None]
+                    elif entry.is_dir(follow_symlinks=False):
+                        content, directories, files, links, files_size, \
+                            path_size, errors, count =  \
+                            DirectoryAsDict._get_directory(
+                                entry.path, debug, directories + 1, files,
+                                links, files_size, path_size, errors, count,
+                                with_stat)
+                        result[name] = [st, content]
+                    else:
+                        links += 1
+                        result[name] = [st, None]
         return result, directories, files, links, files_size, path_size, \
             errors, count
 
@@ -345,7 +526,7 @@ class DirectoryAsDict(object):
             path_size += len(name)
             st, content = content
             if st:
-                st = os.stat(st)
+                st = os.stat_result(st)
                 if stat.S_ISREG(st.st_mode):
                     files += 1
                     files_size += st.st_size
@@ -367,21 +548,463 @@ class DirectoryAsDict(object):
                 count)
 
 
+class DirectoryTree(object):
+
+    '''
+    Compact representation of the contents of a set of directories (as in
+    :class:`DirectoriesCache`): entries are stored in a few arrays instead of
+    nested dicts, lists and stat tuples. The entries of a directory are
+    contiguous, and each entry has:
+
+    - a name, in a string table (``names_data`` bytes and
+      ``names_offsets``)
+    - the index of its parent entry (-1 for the top-level directories, the
+      names of which are their paths)
+    - the index of its first child and its number of children
+    - flags telling whether it has a stat and a content (directory)
+    - mode, inode, size and mtime columns
+    - optionally, the Merkle digest of directories (see
+      :meth:`DirectoriesCache.digest`), in ``digests`` (``digest_size``
+      bytes per entry, zeros if unknown)
+
+    Only these stat values are kept: other ones are 0, and atime and ctime
+    are set to the mtime in the stat tuples returned.
+
+    A tree is built from nested dicts (:meth:`from_directories`), or
+    directly from the filesystem (:meth:`from_directory`), which never
+    holds the nested dicts in memory.
+
+    A tree can be saved in a binary file, and loaded using :mod:`mmap`
+    without reading the whole file: directories are only decoded when they
+    are iterated. Each directory is seen through a dict-like
+    :class:`DirectoryTreeNode`, which can be used as a directory content in
+    :class:`DirectoriesCache`, :class:`DirectoryAsDict` or
+    :meth:`PathToAttributes.parse_directory`.
+    '''
+
+    HAS_STAT = 1
+    HAS_CONTENT = 2
+
+    _magic = b'SOMA_DIRECTORY_TREE 1\n'
+    _arrays = (('names_data', 'uint8'), ('names_offsets', 'int64'),
+               ('parent', 'int64'), ('first_child', 'int64'),
+               ('child_count', 'int64'), ('flags', 'uint8'),
+               ('mode', 'uint32'), ('ino', 'uint64'), ('size', 'int64'),
+               ('mtime', 'int64'), ('digests', 'uint8'))
+    digest_size = 20
+
+    def __init__(self, arrays, roots):
+        for name, dtype in self._arrays:
+            # digests are optional
+            setattr(self, name, arrays.get(name))
+        self.roots = roots
+
+    def __len__(self):
+        return len(self.parent)
+
+    @classmethod
+    def from_directories(cls, directories, digest=None):
+        '''
+        Build a tree from a dict {directory: [st, content]}, as
+        :attr:`DirectoriesCache.directories`. If given, digest(path,
+        content) returns the digest of a directory (or None), stored in the
+        tree.
+        '''
+        import numpy as np
+
+        columns = dict((name, []) for name, dtype in cls._arrays)
+        names = columns['names_data']
+        no_digest = b'\0' * cls.digest_size
+        stat_columns = ((columns['mode'], stat.ST_MODE),
+                        (columns['ino'], stat.ST_INO),
+                        (columns['size'], stat.ST_SIZE),
+                        (columns['mtime'], stat.ST_MTIME))
+
+        def add(name, path, parent, st, content):
+            names.append(os.fsencode(name))
+            if digest is not None:
+                entry_digest = None
+                if content is not None:
+                    entry_digest = digest(path, content)
+                columns['digests'].append(entry_digest or no_digest)
+            columns['parent'].append(parent)
+            columns['first_child'].append(0)
+            columns['child_count'].append(0)
+            flags = 0
+            if st is not None:
+                flags |= cls.HAS_STAT
+                for column, i in stat_columns:
+                    column.append(st[i])
+            else:
+                for column, i in stat_columns:
+                    column.append(0)
+            if content is not None:
+                flags |= cls.HAS_CONTENT
+            columns['flags'].append(flags)
+            return len(names) - 1
+
+        roots = []
+        directories_queue = []
+        for directory, st_content in six.iteritems(directories):
+            st, content = st_content
+            index = add(directory, directory, -1, st, content)
+            roots.append([directory, index])
+            if content is not None:
+                directories_queue.append((index, directory, content))
+        # breadth-first, so that the entries of a directory are contiguous
+        i = 0
+        while i < len(directories_queue):
+            index, path, content = directories_queue[i]
+            directories_queue[i] = None
+            i += 1
+            columns['first_child'][index] = len(names)
+            for name, st_content in six.iteritems(content):
+                st, sub_content = st_content
+                sub_path = osp.join(path, name)
+                child = add(name, sub_path, index, st, sub_content)
+                if sub_content is not None:
+                    directories_queue.append((child, sub_path, sub_content))
+            columns['child_count'][index] = \
+                len(names) - columns['first_child'][index]
+        offsets = [0]
+        for name in names:
+            offsets.append(offsets[-1] + len(name))
+        columns['names_offsets'] = offsets
+        columns['names_data'] = np.frombuffer(b''.join(names),
+                                              dtype='uint8')
+        if digest is not None:
+            columns['digests'] = np.frombuffer(b''.join(columns['digests']),
+                                               dtype='uint8')
+        else:
+            del columns['digests']
+        arrays = dict((name, np.asarray(columns[name], dtype=dtype))
+                      for name, dtype in cls._arrays if name in columns)
+        return cls(arrays, roots)
+
+    @classmethod
+    def from_directory(cls, directory, with_stat=True, debug=None):
+        '''
+        Read a whole directory tree directly in a new tree, without building
+        the nested dicts of :meth:`DirectoryAsDict.get_directory` first. The
+        tree has a single top-level directory, whose content (a dict-like
+        :class:`DirectoryTreeNode`) is ``tree.node(0)``.
+
+        If with_stat is False, no stat is done: entries types come from the
+        directory listing, which is enough for FOM matching.
+        '''
+        from array import array
+        import numpy as np
+
+        names_data = bytearray()
+        columns = dict((name, array(typecode)) for name, typecode in (
+            ('names_offsets', 'q'), ('parent', 'q'), ('first_child', 'q'),
+            ('child_count', 'q'), ('flags', 'B'), ('mode', 'I'),
+            ('ino', 'Q'), ('size', 'q'), ('mtime', 'q')))
+        offsets = columns['names_offsets']
+        offsets.append(0)
+        parent = columns['parent']
+        first_child = columns['first_child']
+        child_count = columns['child_count']
+        flags = columns['flags']
+        stat_columns = ((columns['mode'], stat.ST_MODE),
+                        (columns['ino'], stat.ST_INO),
+                        (columns['size'], stat.ST_SIZE),
+                        (columns['mtime'], stat.ST_MTIME))
+
+        def add(name, parent_index, st, is_directory):
+            names_data.extend(os.fsencode(name))
+            offsets.append(len(names_data))
+            parent.append(parent_index)
+            first_child.append(0)
+            child_count.append(0)
+            entry_flags = (cls.HAS_CONTENT if is_directory else 0)
+            if st is not None:
+                entry_flags |= cls.HAS_STAT
+                for column, i in stat_columns:
+                    column.append(st[i])
+            else:
+                for column, i in stat_columns:
+                    column.append(0)
+            flags.append(entry_flags)
+            return len(parent) - 1
+
+        add(directory, -1, (os.stat(directory) if with_stat else None), True)
+        # breadth-first, so that the entries of a directory are contiguous
+        directories_queue = [(0, directory)]
+        i = 0
+        while i < len(directories_queue):
+            index, path = directories_queue[i]
+            directories_queue[i] = None
+            i += 1
+            if debug and i % 1000 == 0:
+                debug.info('%s directories=%d, entries=%d'
+                           % (time.asctime(), i, len(parent)))
+            try:
+                entries = os.scandir(path)
+            except OSError:
+                # unreadable directory: no content
+                flags[index] &= ~cls.HAS_CONTENT
+                continue
+            first_child[index] = len(parent)
+            with entries:
+                for entry in entries:
+                    is_directory = entry.is_dir(follow_symlinks=False)
+                    st = (entry.stat(follow_symlinks=False)
+                          if with_stat else None)
+                    child = add(entry.name, index, st, is_directory)
+                    if is_directory:
+                        directories_queue.append((child, entry.path))
+            child_count[index] = len(parent) - first_child[index]
+        del directories_queue
+        arrays = {'names_data': np.frombuffer(names_data, dtype='uint8')}
+        for name, dtype in cls._arrays:
+            if name in columns:
+                arrays[name] = _numpy_array(columns.pop(name), dtype)
+        return cls(arrays, [[directory, 0]])
+
+    @classmethod
+    def is_tree_file(cls, path):
+        try:
+            with open(path, 'rb') as f:
+                return f.read(len(cls._magic)) == cls._magic
+        except (IOError, OSError):
+            return False
+
+    def save(self, path):
+        saved_arrays = [(name, dtype) for name, dtype in self._arrays
+                        if getattr(self, name) is not None]
+        arrays = []
+        offset = 0
+        for name, dtype in saved_arrays:
+            array = getattr(self, name)
+            arrays.append([name, dtype, len(array), offset])
+            offset += array.nbytes + (- array.nbytes) % 8
+        header = json.dumps({'roots': self.roots,
+                             'arrays': arrays}).encode('utf-8') + b'\n'
+        with open(path, 'wb') as f:
+            f.write(self._magic)
+            f.write(header)
+            f.write(b'\0' * ((- f.tell()) % 8))
+            for name, dtype in saved_arrays:
+                data = getattr(self, name).tobytes()
+                f.write(data)
+                f.write(b'\0' * ((- len(data)) % 8))
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load a tree saved with :meth:`save`. The file is memory-mapped:
+        arrays are read from it only when they are accessed.
+        '''
+        import mmap
+        import numpy as np
+
+        with open(path, 'rb') as f:
+            if f.read(len(cls._magic)) != cls._magic:
+                raise ValueError('%s is not a directory tree file' % path)
+            header = json.loads(f.readline().decode('utf-8'))
+            data_start = f.tell() + (- f.tell()) % 8
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        arrays = {}
+        for name, dtype, count, offset in header['arrays']:
+            if count == 0:
+                arrays[name] = np.zeros(0, dtype=dtype)
+            else:
+                arrays[name] = np.frombuffer(buffer, dtype=dtype, count=count,
+                                             offset=data_start + offset)
+        return cls(arrays, header['roots'])
+
+    def stat(self, index):
+        if not self.flags[index] & self.HAS_STAT:
+            return None
+        mtime = int(self.mtime[index])
+        return (int(self.mode[index]), int(self.ino[index]), 0, 0, 0, 0,
+                int(self.size[index]), mtime, mtime, mtime)
+
+    def digest(self, index):
+        '''
+        Stored digest of a directory entry, or None.
+        '''
+        if self.digests is None:
+            return None
+        start = index * self.digest_size
+        digest = self.digests[start:start + self.digest_size].tobytes()
+        if digest == b'\0' * self.digest_size:
+            return None
+        return digest
+
+    def node(self, index):
+        '''
+        Content of an entry: a :class:`DirectoryTreeNode`, or None.
+        '''
+        if self.flags[index] & self.HAS_CONTENT:
+            return DirectoryTreeNode(self, index)
+        return None
+
+    def name(self, index):
+        return os.fsdecode(self.names_data[
+            self.names_offsets[index]:self.names_offsets[index + 1]].tobytes())
+
+    def path(self, index):
+        names = []
+        while index >= 0:
+            names.append(self.name(index))
+            index = int(self.parent[index])
+        return osp.join(*reversed(names))
+
+    def directories(self):
+        '''
+        Return the top-level directories as a dict {directory: [st,
+        content]}, as :attr:`DirectoriesCache.directories`.
+        '''
+        return dict((directory, [self.stat(index), self.node(index)])
+                    for directory, index in self.roots)
+
+    def _items(self, index):
+        first = int(self.first_child[index])
+        count = int(self.child_count[index])
+        if count == 0:
+            return
+        end = first + count
+        offsets = self.names_offsets[first:end + 1].tolist()
+        names = self.names_data[offsets[0]:offsets[-1]].tobytes()
+        base = offsets[0]
+        flags = self.flags[first:end].tolist()
+        mode = self.mode[first:end].tolist()
+        ino = self.ino[first:end].tolist()
+        size = self.size[first:end].tolist()
+        mtime = self.mtime[first:end].tolist()
+        for i in range(count):
+            name = os.fsdecode(names[offsets[i] - base:offsets[i + 1] - base])
+            if flags[i] & self.HAS_STAT:
+                st = (mode[i], ino[i], 0, 0, 0, 0, size[i], mtime[i],
+                      mtime[i], mtime[i])
+            else:
+                st = None
+            if flags[i] & self.HAS_CONTENT:
+                content = DirectoryTreeNode(self, first + i)
+            else:
+                content = None
+            yield name, [st, content]
+
+
+def _numpy_array(values, dtype):
+    '''
+    Convert an :class:`array.array` to a numpy array of the given dtype,
+    sharing its memory when the item sizes match.
+    '''
+    import numpy as np
+
+    if values.itemsize == np.dtype(dtype).itemsize:
+        return np.frombuffer(values, dtype=dtype)
+    return np.asarray(values, dtype=dtype)
+
+
+class DirectoryTreeNode(object):
+
+    '''
+    Read-only dict-like view of a directory in a :class:`DirectoryTree`:
+    ``{name: [st, content]}`` where content is a DirectoryTreeNode for
+    directories, and None for other entries.
+    '''
+
+    __slots__ = ('tree', 'index', '_lookup')
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+        self._lookup = None
+
+    def __repr__(self):
+        return '<DirectoryTreeNode( %s )>' % repr(self.tree.path(self.index))
+
+    def __len__(self):
+        return int(self.tree.child_count[self.index])
+
+    def items(self):
+        return self.tree._items(self.index)
+
+    iteritems = items
+
+    def keys(self):
+        return [name for name, st_content in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def values(self):
+        return [st_content for name, st_content in self.items()]
+
+    def __getitem__(self, name):
+        if self._lookup is None:
+            first = int(self.tree.first_child[self.index])
+            self._lookup = dict((item[0], first + i)
+                                for i, item in enumerate(self.items()))
+        index = self._lookup[name]
+        return [self.tree.stat(index), self.tree.node(index)]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def digest(self):
+        '''
+        Merkle digest of the directory stored in the tree (see
+        :meth:`DirectoriesCache.digest`), or None.
+        '''
+        return self.tree.digest(self.index)
+
+    def to_dict(self):
+        '''
+        Convert to nested dicts, as returned by
+        :meth:`DirectoryAsDict.get_directory`.
+        '''
+        return dict((name, [st, content.to_dict()
+                            if content is not None else None])
+                    for name, (st, content) in self.items())
+
+
+def _directory_tree_node_to_json(obj):
+    if isinstance(obj, DirectoryTreeNode):
+        return obj.to_dict()
+    raise TypeError('%s is not JSON serializable' % repr(obj))
+
+
 class DirectoriesCache(object):
 
+    json_format = 'soma_directories_cache_2'
+
     def __init__(self):
         self.directories = {}
+        # time of the last scan of each directory, used to detect
+        # modifications done in the same second (mtimes are in seconds)
+        self.scan_times = {}
+        # path -> Merkle digest of cached directories and subdirectories
+        self.digests = {}
+        # changed directories (and subtrees) whose digests stored in loaded
+        # trees are outdated
+        self._outdated_digests = set()
+        self._outdated_subtrees = set()
 
     def add_directory(self, directory, content=None, debug=None):
         if content is None:
+            self.scan_times[directory] = time.time()
             st = tuple(os.stat(directory))
             content = DirectoryAsDict.get_directory(directory, debug=debug)
         else:
             st = None
         self.directories[directory] = [st, content]
+        self._clear_digests(directory)
 
     def remove_directory(self, directory):
         del self.directories[directory]
+        self.scan_times.pop(directory, None)
+        self._clear_digests(directory)
 
     def has_directory(self, directory):
         return directory in self.directories
@@ -389,27 +1012,436 @@ class DirectoriesCache(object):
     def get_directory(self, directory):
         return self.directories.get(directory)
 
-    def save(self, path):
+    def refresh(self, directory=None, debug=None):
+        '''
+        Incrementally update the cached directories (all of them, or the
+        given one) from the filesystem.
+
+        The mtime and inode of each cached directory are compared with the
+        live filesystem: only directories whose entries changed are listed
+        again, the cached content of the others is reused (their
+        subdirectories are still checked). Directories which could have been
+        modified in the same second they were scanned are also listed
+        again. Modifications of existing files which do not change their
+        directory are not detected. Directories added with a given content
+        are not refreshed, and cached directories which do not exist any
+        longer are removed from the cache.
+
+        Returns a dict with the number of checked directories and the
+        number of listed ones.
+        '''
+        if directory is None:
+            directories = list(self.directories)
+        else:
+            directories = [directory]
+        counts = {'directories': 0, 'listed': 0}
+        for directory in directories:
+            st, content = self.directories[directory]
+            if st is None:
+                continue
+            try:
+                new_st = tuple(os.stat(directory))
+            except OSError:
+                # the directory has been removed
+                self.remove_directory(directory)
+                continue
+            scan_time = self.scan_times.get(directory)
+            self.scan_times[directory] = time.time()
+            changed = []
+            content = self._refresh_directory(directory, st, new_st, content,
+                                              scan_time, counts, changed,
+                                              debug)
+            self.directories[directory] = [new_st, content]
+            for path in changed:
+                self._clear_digests(path, subtree=False)
+        return counts
+
+    @staticmethod
+    def _refresh_directory(directory, st, new_st, content, scan_time,
+                           counts, changed, debug):
+        '''
+        Return the refreshed content of directory: content itself if it is
+        unchanged. Directories whose entries changed are appended to
+        changed.
+        '''
+        counts['directories'] += 1
+        if content is None:
+            counts['listed'] += 1
+            changed.append(directory)
+            return DirectoryAsDict.get_directory(directory)
+        if st is not None and scan_time is not None \
+                and st[stat.ST_INO] == new_st[stat.ST_INO] \
+                and st[stat.ST_MTIME] == new_st[stat.ST_MTIME] \
+                and st[stat.ST_MTIME] < int(scan_time):
+            # same entries: reuse them, only subdirectories have to be
+            # checked
+            result = {}
+            is_changed = False
+            for name, st_content in six.iteritems(content):
+                entry_st, entry_content = st_content
+                if entry_content is not None:
+                    full_path = osp.join(directory, name)
+                    try:
+                        new_entry_st = tuple(os.lstat(full_path))
+                    except OSError:
+                        # removed since the directory stat
+                        is_changed = True
+                        continue
+                    if not stat.S_ISDIR(new_entry_st[stat.ST_MODE]):
+                        # replaced by a file since the directory stat
+                        result[name] = [new_entry_st, None]
+                        is_changed = True
+                        continue
+                    new_entry_content = DirectoriesCache._refresh_directory(
+                        full_path, entry_st, new_entry_st, entry_content,
+                        scan_time, counts, changed, debug)
+                    if new_entry_content is not entry_content:
+                        is_changed = True
+                    result[name] = [new_entry_st, new_entry_content]
+                else:
+                    result[name] = st_content
+            if not is_changed:
+                # keep unchanged contents (and the digests of loaded trees)
+                return content
+            changed.append(directory)
+            return result
+        counts['listed'] += 1
+        changed.append(directory)
+        if debug:
+            debug.info('%s listing %s' % (time.asctime(), directory))
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            return None
+        result = {}
+        with entries:
+            for entry in entries:
+                entry_st = tuple(entry.stat(follow_symlinks=False))
+                if entry.is_dir(follow_symlinks=False):
+                    old = content.get(entry.name)
+                    if old is not None and old[1] is not None:
+                        entry_content = DirectoriesCache._refresh_directory(
+                            entry.path, old[0], entry_st, old[1], scan_time,
+                            counts, changed, debug)
+                    else:
+                        counts['directories'] += 1
+                        counts['listed'] += 1
+                        entry_content = DirectoryAsDict.get_directory(
+                            entry.path, debug=debug)
+                    result[entry.name] = [entry_st, entry_content]
+                else:
+                    result[entry.name] = [entry_st, None]
+        return result
+
+    def _clear_digests(self, directory, subtree=True):
+        '''
+        Forget the digests of a changed directory and of its parent
+        directories (cached directories may be nested), and those of its
+        subdirectories if subtree is True. The digests stored in loaded
+        trees are not used for these directories any longer, those of other
+        directories are kept.
+        '''
+        if subtree:
+            prefix = osp.join(directory, '')
+            for path in [path for path in self.digests
+                         if path.startswith(prefix)]:
+                del self.digests[path]
+            self._outdated_subtrees.add(directory)
+        path = directory
+        while True:
+            self.digests.pop(path, None)
+            self._outdated_digests.add(path)
+            parent = osp.dirname(path)
+            if parent == path:
+                break
+            path = parent
+
+    def _stored_digest(self, path, content):
+        '''
+        Digest of a directory stored in a loaded tree, if it is still valid.
+        '''
+        if not isinstance(content, DirectoryTreeNode) \
+                or path in self._outdated_digests:
+            return None
+        if self._outdated_subtrees:
+            current = path
+            while True:
+                if current in self._outdated_subtrees:
+                    return None
+                parent = osp.dirname(current)
+                if parent == current:
+                    break
+                current = parent
+        return content.digest()
+
+    def _resolve(self, path, content):
+        # a cached directory nested in another one takes precedence over
+        # the content of the enclosing directory
+        st_content = self.directories.get(path)
+        if st_content is not None and st_content[1] is not None:
+            return st_content[1]
+        return content
+
+    def _content(self, path):
+        '''
+        Cached content of a directory, or of one of their subdirectories
+        (None if it is not in the cache).
+        '''
+        root = None
+        for directory in self.directories:
+            if (directory == path
+                    or path.startswith(osp.join(directory, ''))) \
+                    and (root is None or len(directory) > len(root)):
+                root = directory
+        if root is None:
+            return None
+        content = self.directories[root][1]
+        if root != path:
+            for name in path[len(osp.join(root, '')):].split(os.sep):
+                if content is None:
+                    return None
+                st_content = content.get(name)
+                if st_content is None:
+                    return None
+                content = st_content[1]
+        return content
+
+    def digest(self, directory):
+        '''
+        Merkle digest of a cached directory (or of one of their
+        subdirectories): a hash of the sorted names, modes, sizes and
+        mtimes of its entries, where the digest of a subdirectory replaces
+        its stat values. Directories having the same digest have the same
+        content, recursively.
+
+        Digests are computed once, and kept until the directory is changed
+        in the cache. They are saved by :meth:`save`, so that the digests of
+        a loaded cache are not computed again. Return None if the directory
+        is not in the cache.
+        '''
+        digest = self.digests.get(directory)
+        if digest is None:
+            content = self._content(directory)
+            if content is not None:
+                digest = self._digest(directory, content)
+        return digest
+
+    def _digest(self, path, content):
+        digest = self.digests.get(path)
+        if digest is None:
+            digest = self._stored_digest(path, content)
+        if digest is None:
+            h = hashlib.sha1()
+            for name, st_content in sorted(six.iteritems(content),
+                                           key=operator.itemgetter(0)):
+                st, sub_content = st_content
+                if sub_content is not None:
+                    sub_path = osp.join(path, name)
+                    value = b'd' + self._digest(
+                        sub_path, self._resolve(sub_path, sub_content))
+                else:
+                    value = repr(_stat_key(st)).encode('ascii')
+                h.update(os.fsencode(name) + b'\0' + value + b'\0')
+            digest = h.digest()
+        self.digests[path] = digest
+        return digest
+
+    def _all_digests(self):
+        '''
+        Digests of all the cached directories and subdirectories.
+        '''
+        result = {}
+        directories_queue = [(path, st_content[1]) for path, st_content
+                             in six.iteritems(self.directories)
+                             if st_content[1] is not None]
+        while directories_queue:
+            path, content = directories_queue.pop()
+            content = self._resolve(path, content)
+            result[path] = self._digest(path, content)
+            for name, st_content in six.iteritems(content):
+                if st_content[1] is not None:
+                    directories_queue.append((osp.join(path, name),
+                                              st_content[1]))
+        return result
+
+    @staticmethod
+    def diff(old, new, directory):
+        '''
+        Iterate over the changes of a directory between two caches (two
+        snapshots of a directory tree saved at different times for
+        instance), as (change, path, st) tuples. change is "added",
+        "removed" or "modified", path is the list of names of the entry
+        relative to directory, and st is the stat of the entry in the new
+        cache (in the old one for removed entries). The entries of an added
+        or removed directory are also reported. A file replaced by a
+        directory, or the reverse, is reported as removed and added.
+
+        Subdirectories having the same digest (see :meth:`digest`) in both
+        caches are skipped without being walked.
+
+        Use :meth:`changes_to_dict` to parse the added and modified entries
+        with :meth:`PathToAttributes.parse_directory`.
+        '''
+        old_content = old._content(directory)
+        new_content = new._content(directory)
+        if old_content is None and new_content is None:
+            raise ValueError('%s is in none of the caches' % directory)
+        if old_content is None:
+            changes = new._subtree_changes('added', directory, new_content,
+                                           [])
+        elif new_content is None:
+            changes = old._subtree_changes('removed', directory, old_content,
+                                           [])
+        else:
+            changes = DirectoriesCache._diff_directory(
+                old, new, directory, [], old_content, new_content)
+        for change in changes:
+            yield change
+
+    @staticmethod
+    def _diff_directory(old, new, path, names, old_content, new_content):
+        if old._digest(path, old_content) == new._digest(path, new_content):
+            return
+        old_items = dict(six.iteritems(old_content))
+        new_items = dict(six.iteritems(new_content))
+        for name in sorted(set(old_items).union(new_items)):
+            entry_path = osp.join(path, name)
+            entry_names = names + [name]
+            old_st_content = old_items.get(name)
+            new_st_content = new_items.get(name)
+            if old_st_content is not None and new_st_content is not None:
+                old_st, old_entry = old_st_content
+                new_st, new_entry = new_st_content
+                if old_entry is not None and new_entry is not None:
+                    for change in DirectoriesCache._diff_directory(
+                            old, new, entry_path, entry_names,
+                            old._resolve(entry_path, old_entry),
+                            new._resolve(entry_path, new_entry)):
+                        yield change
+                    continue
+                if old_entry is None and new_entry is None:
+                    if _stat_key(old_st) != _stat_key(new_st):
+                        yield ('modified', entry_names, new_st)
+                    continue
+            if old_st_content is not None:
+                yield ('removed', entry_names, old_st_content[0])
+                if old_st_content[1] is not None:
+                    for change in old._subtree_changes(
+                            'removed', entry_path, old_st_content[1],
+                            entry_names):
+                        yield change
+            if new_st_content is not None:
+                yield ('added', entry_names, new_st_content[0])
+                if new_st_content[1] is not None:
+                    for change in new._subtree_changes(
+                            'added', entry_path, new_st_content[1],
+                            entry_names):
+                        yield change
+
+    def _subtree_changes(self, change, path, content, names):
+        content = self._resolve(path, content)
+        for name, st_content in sorted(six.iteritems(content),
+                                       key=operator.itemgetter(0)):
+            st, sub_content = st_content
+            yield (change, names + [name], st)
+            if sub_content is not None:
+                for i in self._subtree_changes(change, osp.join(path, name),
+                                               sub_content, names + [name]):
+                    yield i
+
+    @staticmethod
+    def changes_to_dict(changes):
+        '''
+        Build a directory dict ({name: [st, content]}) containing the
+        added and modified entries of :meth:`diff` changes (and their parent
+        directories), which can be parsed with
+        :meth:`PathToAttributes.parse_directory`.
+        '''
+        result = {}
+        for change, names, st in changes:
+            if change == 'removed':
+                continue
+            current = result
+            for name in names[:-1]:
+                st_content = current.setdefault(name, [None, {}])
+                if st_content[1] is None:
+                    st_content[1] = {}
+                current = st_content[1]
+            st_content = current.setdefault(names[-1], [st, None])
+            st_content[0] = st
+            if st is not None and _is_directory(st) \
+                    and st_content[1] is None:
+                st_content[1] = {}
+        return result
+
+    def save(self, path, format='json'):
+        '''
+        Save the cache in a file. format may be "json" (bz2-compressed JSON
+        when bz2 is available) or "binary" (memory-mappable
+        :class:`DirectoryTree` file, see :meth:`DirectoryTree.save`). The
+        digests of directories (see :meth:`digest`) are computed and saved
+        too.
+        '''
+        if format == 'binary':
+            DirectoryTree.from_directories(
+                self.directories, digest=self._digest_of).save(path)
+            return
+        if format != 'json':
+            raise ValueError('Unknown DirectoriesCache format: %s' % format)
+        digests = dict((directory, binascii.hexlify(digest).decode('ascii'))
+                       for directory, digest
+                       in six.iteritems(self._all_digests()))
         if bz2:
-            f = bz2.BZ2File(path, 'w')
+            f = bz2.open(path, 'wt')
         else:
             f = open(path, 'w')
         with f:
-            json.dump(self.directories, f)
+            json.dump({'format': self.json_format,
+                       'directories': self.directories,
+                       'digests': digests}, f,
+                      default=_directory_tree_node_to_json)
+
+    def _digest_of(self, path, content):
+        return self._digest(path, self._resolve(path, content))
+
+    @classmethod
+    def _from_json(cls, data):
+        '''
+        Cached directories and digests of JSON data written by :meth:`save`
+        (caches written by older versions have no digests).
+        '''
+        if data.get('format') == cls.json_format:
+            return data['directories'], dict(
+                (directory, binascii.unhexlify(digest))
+                for directory, digest in six.iteritems(data['digests']))
+        return data, {}
 
     @classmethod
     def load(cls, path):
+        '''
+        Load a cache saved by :meth:`save`, in any format. Directories of
+        binary caches are :class:`DirectoryTreeNode` instances, read from the
+        memory-mapped file on demand.
+        '''
         result = cls()
-        if bz2:
-            try:
-                with bz2.BZ2File(path, 'r') as f:
-                    result.directories = json.load(f)
-            except IOError:
-                with open(path, 'r') as f:
-                    result.directories = json.load(f)
+        if DirectoryTree.is_tree_file(path):
+            result.directories = DirectoryTree.load(path).directories()
         else:
-            with open(path, 'r') as f:
-                result.directories = json.load(f)
+            if bz2:
+                try:
+                    with bz2.open(path, 'rt') as f:
+                        data = json.load(f)
+                except IOError:
+                    with open(path, 'r') as f:
+                        data = json.load(f)
+            else:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+            result.directories, result.digests = cls._from_json(data)
+        # the cache has been written after the scan
+        scan_time = os.stat(path).st_mtime
+        result.scan_times = dict((directory, scan_time)
+                                 for directory in result.directories)
         return result
 
 
@@ -422,9 +1454,25 @@ class FileOrganizationModelManager(object):
     contained in a predefined set of directories (see find_fom method) and to
     instantiate a FileOrganizationModel for each identified file (see get_fom
     method).
+
+    If cache_directory is given, the FOM name of each file is recorded in a
+    registry file (fom_registry.json) in this directory, along with the
+    file modification time and size. :meth:`find_foms` only reads the
+    files that changed since the registry was written. :meth:`load_foms`
+    also saves the loaded FileOrganizationModels in this directory (a
+    "bundle"), and reuses it as long as the content of all the FOM files
+    it was built from is unchanged. Only the latest bundle of a given list
+    of FOM names is kept.
+
+    Bundles are unpickled, so the cache directory must only be writable by
+    trusted users: bundles which are not owned by the current user, or
+    which are writable by other users, are ignored.
     '''
 
-    def __init__(self, paths=None):
+    registry_version = 1
+    bundle_version = 2
+
+    def __init__(self, paths=None, cache_directory=None):
         '''
         Create a FOM manager that will use the given paths to find available FOMs.
         '''
@@ -432,6 +1480,7 @@ class FileOrganizationModelManager(object):
             paths = [osp.join(osp.dirname(osp.dirname(osp.dirname(__file__))),
                               'share', 'foms')]
         self.paths = paths
+        self.cache_directory = cache_directory
         self._cache = None
 
     def find_foms(self):
@@ -442,6 +1491,8 @@ class FileOrganizationModelManager(object):
         #import time
         #t0 = time.time()
         self._cache = {}
+        registry = self._read_registry()
+        new_registry = {}
         for path in self.paths:
             # print('   ', path)
             if os.path.isdir(path):
@@ -451,25 +1502,84 @@ class FileOrganizationModelManager(object):
                         for ext in ('.json', '.yaml'):
                             main_file = osp.join(full_path, i + ext)
                             if osp.exists(main_file):
-                                d = read_json(main_file)
-                                name = d.get('fom_name')
+                                name = self._fom_name(main_file, registry,
+                                                      new_registry)
                                 if not name:
                                     raise ValueError(
                                         'file %s does not contain fom_name'
                                         % main_file)
                                 self._cache[name] = full_path
                     elif i.endswith('.json') or i.endswith('.yaml'):
-                        d = read_json(full_path)
-                        if d:
-                            name = d.get('fom_name')
-                            if not name:
-                                raise ValueError(
-                                    'file %s does not contain fom_name'
-                                    % full_path)
+                        name = self._fom_name(full_path, registry,
+                                              new_registry, allow_empty=True)
+                        if name:
                             self._cache[name] = full_path
+        if self.cache_directory and new_registry != registry:
+            self._write_registry(new_registry)
         #print('    find_foms done: %f s' % (time.time() - t0))
         return list(self._cache.keys())
 
+    def _registry_file(self):
+        return osp.join(self.cache_directory, 'fom_registry.json')
+
+    def _read_registry(self):
+        '''
+        Return the registry dict {file: [mtime, size, fom_name]} read from
+        the cache directory, or an empty dict.
+        '''
+        if not self.cache_directory:
+            return {}
+        try:
+            with open(self._registry_file()) as f:
+                registry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(registry, dict) \
+                or registry.get('version') != self.registry_version:
+            return {}
+        return registry.get('files', {})
+
+    def _write_registry(self, registry):
+        registry_file = self._registry_file()
+        try:
+            if not osp.isdir(self.cache_directory):
+                os.makedirs(self.cache_directory)
+            tmp_file = '%s.%d.tmp' % (registry_file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump({'version': self.registry_version,
+                           'files': registry}, f)
+            if osp.exists(registry_file):
+                # os.rename cannot replace a file on Windows
+                os.remove(registry_file)
+            os.rename(tmp_file, registry_file)
+        except (IOError, OSError):
+            # the registry is only an optimization
+            pass
+
+    @staticmethod
+    def _fom_name(fom_file, registry, new_registry, allow_empty=False):
+        '''
+        Return the fom_name of a FOM file, using the registry if the file
+        is unchanged, and record it in new_registry. Files without
+        fom_name raise a ValueError unless allow_empty is True and the file
+        is empty.
+        '''
+        st = os.stat(fom_file)
+        entry = registry.get(fom_file)
+        if entry and entry[:2] == [st.st_mtime, st.st_size]:
+            name = entry[2]
+        else:
+            d = read_json(fom_file)
+            if not d and allow_empty:
+                name = None
+            else:
+                name = d.get('fom_name') if d else None
+                if not name:
+                    raise ValueError('file %s does not contain fom_name'
+                                     % fom_file)
+        new_registry[fom_file] = [st.st_mtime, st.st_size, name]
+        return name
+
     def fom_files(self):
         '''Return a list of file organisation model (FOM) names, as in
         :meth:`find_foms`, but does not clear and reload the cache.
@@ -482,14 +1592,105 @@ class FileOrganizationModelManager(object):
     def clear_cache(self):
         self._cache = None
 
-    def load_foms(self, *names):
+    def load_foms(self, *names, **kwargs):
+        '''
+        Load the given FOMs in a FileOrganizationModels. If the keyword
+        argument lazy is True, processes rules are only built when needed
+        (see :class:`FileOrganizationModels`).
+        '''
+        lazy = kwargs.pop('lazy', False)
+        if kwargs:
+            raise TypeError('unexpected keyword arguments: %s'
+                            % ', '.join(kwargs))
         if self._cache is None:
             self.find_foms()
-        foms = FileOrganizationModels()
+        bundle_file = None
+        if self.cache_directory:
+            bundle_file = self._bundle_file(names, lazy)
+            foms = self._read_bundle(bundle_file)
+            if foms is not None:
+                return foms
+        foms = FileOrganizationModels(lazy=lazy)
         for name in names:
             foms.import_file(self._cache[name], foms_manager=self)
+        if bundle_file:
+            self._write_bundle(bundle_file, foms)
         return foms
 
+    def _bundle_prefix(self, names, lazy=False):
+        key = repr([list(names), lazy])
+        return 'fom_bundle_%s_' \
+            % hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+    def _bundle_file(self, names, lazy=False):
+        key = repr([self.bundle_version, names, lazy,
+                    [self._cache[name] for name in names]])
+        return osp.join(self.cache_directory, '%s%s.pickle'
+                        % (self._bundle_prefix(names, lazy),
+                           hashlib.sha1(key.encode('utf-8')).hexdigest()))
+
+    @staticmethod
+    def _file_hash(file_name):
+        with open(file_name, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def _read_bundle(self, bundle_file):
+        '''
+        Return the FileOrganizationModels saved in bundle_file, or None if
+        it does not exist or if one of the FOM files it was built from has
+        changed.
+        '''
+        try:
+            with open(bundle_file, 'rb') as f:
+                if hasattr(os, 'getuid'):
+                    st = os.fstat(f.fileno())
+                    if st.st_uid != os.getuid() \
+                            or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                        return None
+                bundle = six.moves.cPickle.load(f)
+            if bundle.get('version') != self.bundle_version:
+                return None
+            for name, file_name in six.iteritems(bundle['fom_files']):
+                if self._cache.get(name) != file_name:
+                    return None
+            for file_name, file_hash in bundle['hashes']:
+                if self._file_hash(file_name) != file_hash:
+                    return None
+        except Exception:
+            # missing, outdated or corrupted bundle
+            return None
+        return bundle['foms']
+
+    def _write_bundle(self, bundle_file, foms):
+        bundle = {
+            'version': self.bundle_version,
+            'fom_files': dict((name, self._cache.get(name))
+                              for name in foms.fom_names),
+            'foms': foms,
+        }
+        try:
+            bundle['hashes'] = [(file_name, self._file_hash(file_name))
+                                for file_name in foms.imported_files]
+            if not osp.isdir(self.cache_directory):
+                os.makedirs(self.cache_directory)
+            tmp_file = '%s.%d.tmp' % (bundle_file, os.getpid())
+            with open(tmp_file, 'wb') as f:
+                six.moves.cPickle.dump(bundle, f,
+                                       six.moves.cPickle.HIGHEST_PROTOCOL)
+            if osp.exists(bundle_file):
+                os.remove(bundle_file)
+            os.rename(tmp_file, bundle_file)
+            # remove the bundles of the same FOMs built from other files
+            name = osp.basename(bundle_file)
+            prefix = name[:name.rindex('_') + 1]
+            for other in os.listdir(self.cache_directory):
+                if other.startswith(prefix) and other.endswith('.pickle') \
+                        and other != name:
+                    os.remove(osp.join(self.cache_directory, other))
+        except (IOError, OSError):
+            # the bundle is only an optimization
+            pass
+
     def file_name(self, fom):
         if self._cache is None:
             self.find_foms()
@@ -519,7 +1720,17 @@ class FileOrganizationModelManager(object):
 
 class FileOrganizationModels(object):
 
-    def __init__(self):
+    '''
+    Set of rules and attributes definitions built from one or several FOM
+    definitions (see :meth:`import_file`).
+
+    In lazy mode, the processes definitions are kept unexpanded at import
+    time. The rules of a process are built when a selection refers to it
+    (see :meth:`expand_processes`), or when a selection does not restrict
+    fom_process. Rules are kept in the same order as in non lazy mode.
+    '''
+
+    def __init__(self, lazy=False):
         self._directories_regex = re.compile(r'{([A-Za-z][A-Za-z0-9_]*)}')
         self._attributes_regex = re.compile('<([^>]+)>')
         self.fom_names = []
@@ -538,6 +1749,16 @@ class FileOrganizationModels(object):
         self.shared_patterns = {}
         self.patterns = {}
         self.rules = []
+        # FOM files read by import_file()
+        self.imported_files = []
+        self.lazy = lazy
+        # process name -> list of (block order, fom_name, parameters,
+        # (shared_patterns, format_lists)) for processes not expanded yet
+        self._lazy_processes = OrderedDict()
+        # (block order, rules count) for each block of rules added to
+        # self.rules
+        self._rules_blocks = []
+        self._next_block_order = 0
 
     def _expand_shared_pattern(self, pattern):
         expanded_pattern = []
@@ -560,6 +1781,7 @@ class FileOrganizationModels(object):
     def import_file(self, file_or_dict, foms_manager=None):
         if not isinstance(file_or_dict, dict):
             json_dict = read_json(file_or_dict)
+            self.imported_files.append(file_or_dict)
         else:
             json_dict = file_or_dict
 
@@ -644,38 +1866,116 @@ class FileOrganizationModels(object):
         new_patterns = {}
         self._expand_json_patterns(
             patterns, new_patterns, {'fom_name': fom_name})
-        self._parse_patterns(new_patterns, self.patterns)
+        self._add_rules_block(self._new_block_order(), self._parse_patterns,
+                              new_patterns, self.patterns)
 
         if processes:
-            process_patterns = OrderedDict()
-            for process, parameters in six.iteritems(processes):
-                process_dict = OrderedDict()
-                process_patterns[process] = process_dict
-                for parameter, rules in six.iteritems(parameters):
-                    if isinstance(rules, six.string_types):
-                        rules = self.shared_patterns[rules[1:-1]]
-                    parameter_rules = []
-                    process_dict[parameter] = parameter_rules
-                    for rule in rules:
-                        if len(rule) == 2:
-                            pattern, formats = rule
-                            rule_attributes = {}
-                        else:
-                            try:
-                                pattern, formats, rule_attributes = rule
-                            except Exception as e:
-                                print('error in FOM: %s, process: %s, param: '
-                                    '%s, rule:'
-                                    % (fom_name, process, parameter), rule)
-                                raise
-                        rule_attributes['fom_process'] = process
-                        rule_attributes['fom_parameter'] = parameter
-                        parameter_rules.append(
-                            [pattern, formats, rule_attributes])
-            new_patterns = OrderedDict()
-            self._expand_json_patterns(
-                process_patterns, new_patterns, {'fom_name': fom_name})
-            self._parse_patterns(new_patterns, self.patterns)
+            if self.lazy:
+                # expansion depends on the shared patterns and format lists
+                # defined so far
+                context = (self.shared_patterns.copy(),
+                           self.format_lists.copy())
+                for process, parameters in six.iteritems(processes):
+                    self._lazy_processes.setdefault(process, []).append(
+                        (self._new_block_order(), fom_name, parameters,
+                         context))
+                    self.attribute_definitions.setdefault(
+                        'fom_process', {}).setdefault(
+                            'values', set()).add(process)
+                    self.attribute_definitions.setdefault(
+                        'fom_parameter', {}).setdefault(
+                            'values', set()).update(parameters)
+            else:
+                self._add_rules_block(self._new_block_order(),
+                                      self._import_processes, fom_name,
+                                      processes)
+
+    def _new_block_order(self):
+        order = self._next_block_order
+        self._next_block_order += 1
+        return order
+
+    def _add_rules_block(self, order, function, *args):
+        '''
+        Call function(*args), which appends rules to self.rules, then move
+        these new rules to the position of the block order among the
+        blocks already added.
+        '''
+        start = len(self.rules)
+        function(*args)
+        count = len(self.rules) - start
+        position = 0
+        index = len(self._rules_blocks)
+        for i, (block_order, block_count) in enumerate(self._rules_blocks):
+            if block_order > order:
+                index = i
+                break
+            position += block_count
+        self._rules_blocks.insert(index, (order, count))
+        if position != start:
+            new_rules = self.rules[start:]
+            del self.rules[start:]
+            self.rules[position:position] = new_rules
+
+    def _import_processes(self, fom_name, processes):
+        process_patterns = OrderedDict()
+        for process, parameters in six.iteritems(processes):
+            process_dict = OrderedDict()
+            process_patterns[process] = process_dict
+            for parameter, rules in six.iteritems(parameters):
+                if isinstance(rules, six.string_types):
+                    rules = self.shared_patterns[rules[1:-1]]
+                parameter_rules = []
+                process_dict[parameter] = parameter_rules
+                for rule in rules:
+                    if len(rule) == 2:
+                        pattern, formats = rule
+                        rule_attributes = {}
+                    else:
+                        try:
+                            pattern, formats, rule_attributes = rule
+                        except Exception as e:
+                            print('error in FOM: %s, process: %s, param: '
+                                '%s, rule:'
+                                % (fom_name, process, parameter), rule)
+                            raise
+                    rule_attributes['fom_process'] = process
+                    rule_attributes['fom_parameter'] = parameter
+                    parameter_rules.append(
+                        [pattern, formats, rule_attributes])
+        new_patterns = OrderedDict()
+        self._expand_json_patterns(
+            process_patterns, new_patterns, {'fom_name': fom_name})
+        self._parse_patterns(new_patterns, self.patterns)
+
+    def expand_processes(self, selection=None):
+        '''
+        In lazy mode, build the rules of the processes that selection
+        refers to with its fom_process value (a process name or a list of
+        names). All processes are expanded if selection does not contain
+        fom_process. Does nothing when all processes are already expanded.
+        '''
+        if not self._lazy_processes:
+            return
+        processes = (selection or {}).get('fom_process')
+        if processes is None:
+            processes = list(self._lazy_processes)
+        elif isinstance(processes, six.string_types):
+            processes = [processes]
+        for process in processes:
+            definitions = self._lazy_processes.pop(process, None)
+            if not definitions:
+                continue
+            for order, fom_name, parameters, context in definitions:
+                shared_patterns = self.shared_patterns
+                format_lists = self.format_lists
+                self.shared_patterns, self.format_lists = context
+                try:
+                    self._add_rules_block(order, self._import_processes,
+                                          fom_name, {process: parameters})
+                finally:
+                    self.shared_patterns = shared_patterns
+                    self.format_lists = format_lists
 
     def get_attributes_without_value(self):
         att_no_value = {}
@@ -688,6 +1988,7 @@ class FileOrganizationModels(object):
         return att_no_value
 
     def selected_rules(self, selection, debug=None):
+        self.expand_processes(selection)
         if selection:
             format = selection.get('format')
             for rule_pattern, rule_attributes in self.rules:
@@ -846,16 +2147,226 @@ class FileOrganizationModels(object):
             pprint.pprint(getattr(self, i), out)
 
 
+class _SuffixTrie(object):
+
+    '''
+    Trie of the reversed file extensions registered in FOMs formats, used
+    to find the extensions a name actually ends with in a single backward
+    scan of its last characters.
+    '''
+
+    def __init__(self, extensions):
+        self.root = {}
+        for extension in extensions:
+            if extension:
+                node = self.root
+                for c in reversed('.' + extension):
+                    node = node.setdefault(c, {})
+                node[None] = extension
+
+    def extensions(self, name):
+        '''
+        Tuple of the registered extensions ending name (after a dot), the
+        longest (most dotted) first.
+        '''
+        result = []
+        node = self.root
+        for c in reversed(name):
+            node = node.get(c)
+            if node is None:
+                break
+            extension = node.get(None)
+            if extension is not None:
+                result.append(extension)
+        result.reverse()
+        return tuple(result)
+
+
+class _LevelMatcher(object):
+
+    '''
+    Compiled matcher for one level of the hierarchical patterns of
+    :class:`PathToAttributes`.
+
+    The registered extensions ending an entry name are found with a
+    :class:`_SuffixTrie`, so only the extension splits that may actually
+    match rules are tried: for each of them (most dotted extensions first,
+    which gives the left-most split priority), the name without extension is
+    matched against the patterns having rules for this extension. The whole
+    name is then matched against the patterns having sub-patterns, as a
+    directory.
+
+    Patterns are also indexed on the first character of their literal
+    prefix (and directory patterns on the last character of their literal
+    suffix). All the candidate patterns of an index bucket are merged into a
+    single regular expression in which each pattern is an optional
+    lookahead, with named groups renamed per pattern, so that one
+    ``match()`` call tells which patterns match and the values of their
+    attributes. Merged regexes are built and compiled once per index
+    bucket. Those containing values of attributes found in parent
+    directories (``%(attribute)s``) are compiled for each set of values with
+    the given ``compile`` function.
+    '''
+
+    _group_regex = re.compile(r'\(\?P<([A-Za-z_][A-Za-z0-9_]*)>')
+
+    def __init__(self, hierarchical_patterns, affixes, suffix_trie):
+        self.suffix_trie = suffix_trie
+        self.patterns = []
+        self.prefix_index = {}
+        self.prefix_any = set()
+        self.extension_index = {}
+        self.suffix_index = {}
+        self.suffix_any = set()
+        self._buckets = {}
+        for pattern, rules_subpattern in six.iteritems(hierarchical_patterns):
+            ext_rules, subpattern = rules_subpattern
+            index = len(self.patterns)
+            extensions = [ext for ext in ext_rules if ext]
+            submatcher = None
+            prefix, suffix = affixes[pattern]
+            if subpattern:
+                submatcher = _LevelMatcher(subpattern, affixes, suffix_trie)
+                if suffix:
+                    self.suffix_index.setdefault(suffix[-1], set()).add(index)
+                else:
+                    self.suffix_any.add(index)
+            elif not extensions:
+                # neither a file nor a directory can match this pattern
+                continue
+            self.patterns.append((pattern, ext_rules, submatcher,
+                                  pattern[1:-1]))
+            for ext in extensions:
+                self.extension_index.setdefault(ext, set()).add(index)
+            if prefix:
+                self.prefix_index.setdefault(prefix[0], set()).add(index)
+            else:
+                self.prefix_any.add(index)
+
+    def _rename_groups(self, regex, group_prefix, groups):
+        def rename(match):
+            group = group_prefix + match.group(1)
+            groups.append((group, match.group(1)))
+            return '(?P<%s>' % group
+        return self._group_regex.sub(rename, regex)
+
+    def pattern_list(self):
+        return [i[0] for i in self.patterns]
+
+    def _bucket(self, first, ext, last):
+        '''
+        Merged regex for the candidate patterns of names starting with
+        first. If ext is given, the regex matches the name without this
+        extension, otherwise it matches whole names of directories ending
+        with last.
+        '''
+        key = (first, ext, last)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if ext:
+                candidates = self.extension_index[ext]
+            else:
+                candidates = self.suffix_index.get(last, set()) \
+                    | self.suffix_any
+            candidates = candidates & (self.prefix_index.get(first, set())
+                                       | self.prefix_any)
+            regex = ['^']
+            patterns = []
+            for index in sorted(candidates):
+                pattern, ext_rules, submatcher, body = self.patterns[index]
+                groups = []
+                marker = 'm%d' % index
+                regex.append('(?:(?=%s$)(?P<%s>))?' % (
+                    self._rename_groups(body, 'a%d_' % index, groups),
+                    marker))
+                patterns.append((index, marker, groups))
+            regex = ''.join(regex)
+            if '%(' in regex:
+                compiled = None
+            else:
+                compiled = re.compile(regex)
+            bucket = (regex, compiled, patterns)
+            self._buckets[key] = bucket
+        return bucket
+
+    def _match_bucket(self, string, bucket, ext, pattern_attributes,
+                      compile, matches):
+        regex, compiled, patterns = bucket
+        if not patterns:
+            return
+        if compiled is None:
+            compiled = compile(regex % pattern_attributes)
+        match = compiled.match(string)
+        for index, marker, groups in patterns:
+            if index not in matches and match.group(marker) is not None:
+                matches[index] = (ext, dict((attribute, match.group(group))
+                                            for group, attribute in groups))
+
+    def match(self, name, pattern_attributes, compile=re.compile):
+        '''
+        Iterate over the patterns matching the given entry name. For each of
+        them, yields a tuple (pattern, ext, ext_rules, submatcher,
+        attributes). ext is the matched extension (a key of ext_rules), or an
+        empty string if the whole name matched a pattern having
+        sub-patterns.
+        '''
+        first = name[:1]
+        if first not in self.prefix_index:
+            first = None
+        # pattern index -> (ext, attributes) of its first matching split
+        matches = {}
+        for ext in self.suffix_trie.extensions(name):
+            if ext in self.extension_index:
+                self._match_bucket(name[:-len(ext) - 1],
+                                   self._bucket(first, ext, None), ext,
+                                   pattern_attributes, compile, matches)
+        last = name[-1:]
+        if last not in self.suffix_index:
+            last = None
+        self._match_bucket(name, self._bucket(first, None, last), '',
+                           pattern_attributes, compile, matches)
+        for index in sorted(matches):
+            pattern, ext_rules, submatcher, body = self.patterns[index]
+            ext, attributes = matches[index]
+            yield pattern, ext, ext_rules, submatcher, attributes
+
+
 class PathToAttributes(object):
 
     '''
     Utility class for file paths -> attributes set transformation.
     Part of the FOM engine.
+
+    Patterns depending on attributes values found in parent directories are
+    compiled for each set of values. Compiled regexes are kept in a cache of
+    at most regex_cache_size entries (None for an unbounded cache), see
+    :meth:`regex_cache_info`.
     '''
 
-    def __init__(self, foms, selection=None):
+    def __init__(self, foms, selection=None, regex_cache_size=1024):
+        self._build([foms], selection, regex_cache_size)
+
+    def _build(self, foms_list, selection, regex_cache_size):
         self._attributes_regex = re.compile('<([^>]+)>')
+        self._regex_cache = _LRUCache(regex_cache_size)
         self.hierarchical_patterns = OrderedDict()
+        # literal prefix and suffix of each pattern regex, used to build the
+        # dispatch index of the compiled matchers
+        affixes = {}
+        for foms in foms_list:
+            self._add_rules(foms, selection, affixes)
+        # registered extensions, so that only the extension splits of names
+        # that may match rules are tried
+        self._suffix_trie = _SuffixTrie(set(
+            itertools.chain.from_iterable(six.itervalues(foms.formats)
+                                          for foms in foms_list)))
+        self._matcher = _LevelMatcher(self.hierarchical_patterns, affixes,
+                                      self._suffix_trie)
+
+    def _add_rules(self, foms, selection, affixes):
+        '''
+        Add the selected rules of foms to :attr:`hierarchical_patterns`.
+        '''
         for rule_pattern, rule_attributes in foms.selected_rules(selection):
             rule_formats = rule_attributes.get('fom_formats', [])
             parent = self.hierarchical_patterns
@@ -866,7 +2377,10 @@ class PathToAttributes(object):
                 count += 1
                 regex = ['^']
                 last_end = 0
+                first_start = None
                 for match in self._attributes_regex.finditer(pattern):
+                    if first_start is None:
+                        first_start = match.start()
                     c = pattern[last_end: match.start()]
                     if c:
                         regex.append(re.escape(c))
@@ -893,6 +2407,11 @@ class PathToAttributes(object):
                 last = pattern[last_end:]
                 if last:
                     regex.append(re.escape(last))
+                regex = ''.join(regex) + '$'
+                if first_start is None:
+                    affixes[regex] = (pattern, pattern)
+                else:
+                    affixes[regex] = (pattern[:first_start], last)
                 if count == len(splited_pattern):
                     if rule_formats:
                         for format in rule_formats:
@@ -903,14 +2422,39 @@ class PathToAttributes(object):
                             d = rule_attributes.copy()
                             d['fom_format'] = format
                             d.pop('fom_formats', None)
-                            parent.setdefault(''.join(regex) + '$', [OrderedDict(), OrderedDict()])[
+                            parent.setdefault(regex, [OrderedDict(), OrderedDict()])[
                                 0].setdefault(extension, []).append(d)
                     else:
-                        parent.setdefault(''.join(regex) + '$', [OrderedDict(), OrderedDict()])[
+                        parent.setdefault(regex, [OrderedDict(), OrderedDict()])[
                             0].setdefault('', []).append(rule_attributes)
                 else:
                     parent = parent.setdefault(
-                        ''.join(regex) + '$', [OrderedDict(), OrderedDict()])[1]
+                        regex, [OrderedDict(), OrderedDict()])[1]
+
+    def _compile(self, pattern):
+        regex = self._regex_cache.get(pattern)
+        if regex is None:
+            regex = re.compile(pattern)
+            self._regex_cache.put(pattern, regex)
+        return regex
+
+    @property
+    def regex_cache_hits(self):
+        return self._regex_cache.hits
+
+    @property
+    def regex_cache_misses(self):
+        return self._regex_cache.misses
+
+    def regex_cache_info(self):
+        '''
+        Return a dict with the hits, misses, size and maxsize of the compiled
+        regexes cache.
+        '''
+        return self._regex_cache.info()
+
+    def clear_regex_cache(self):
+        self._regex_cache.clear()
 
     def pprint(self, file=sys.stdout):
         self._pprint(file, self.hierarchical_patterns, 0)
@@ -939,97 +2483,75 @@ class PathToAttributes(object):
     def parse_directory(self, dirdict, single_match=False, all_unknown=False, log=None):
         if isinstance(dirdict, six.string_types):
             dirdict = DirectoryAsDict.paths_to_dict(dirdict)
-        return self._parse_directory(dirdict, [([], self.hierarchical_patterns, {})], single_match, all_unknown, log)
+        return self._parse_directory(dirdict, [([], self._matcher, {})], single_match, all_unknown, log)
 
-    def _parse_directory(self, dirdict, parsing_list, single_match, all_unknown, log):
+    def _parse_directory(self, dirdict, parsing_list, single_match, all_unknown, log,
+                         shards=None, depth=0):
         for name, content in six.iteritems(dirdict):
             st, content = content
-            # Split extension on left most dot
-            l = name.split('.')
-            possible_extension_split = [('.'.join(l[:i]), '.'.join(l[i:]))
-                                        for i in range(1, len(l) + 1)]
-            # split = name.split('.', 1)
-            # name_no_ext = split[0]
-            # if len(split) == 2:
-                # ext = split[1]
-            # else:
-                # ext = ''
-
             matched_directories = []
             matched = False
             sent = False
             recurse_parsing_list = []
-            for path, hierarchical_patterns, pattern_attributes in parsing_list:
+            for path, matcher, pattern_attributes in parsing_list:
                 if log:
                     log.debug('?? ' + name + ' ' + repr(
-                        pattern_attributes) + ' ' + repr(list(hierarchical_patterns.keys())))
+                        pattern_attributes) + ' ' + repr(matcher.pattern_list()))
                 branch_matched = False
-                for pattern, rules_subpattern \
-                        in six.iteritems(hierarchical_patterns):
+                for pattern, ext, ext_rules, submatcher, new_attributes \
+                        in matcher.match(name, pattern_attributes,
+                                         self._compile):
+                    if log:
+                        log.debug('match %s for %s, extension: %s'
+                                  % (repr(pattern), repr(name), repr(ext)))
+                    new_attributes.update(pattern_attributes)
                     stop_parsing = False
-                    for name_no_ext, ext in possible_extension_split:
-                        ext_rules, subpattern = rules_subpattern
-                        pattern = pattern % pattern_attributes
-                        match = re.match(pattern, name_no_ext)
-                        if log:
+                    if not ext:
+                        # the pattern matched the whole name, and the
+                        # matcher only reports it if it has sub-patterns
+                        if content is not None \
+                                and (st is None or _is_directory(st)):
+                            matched = branch_matched = True
+                            stop_parsing = single_match
+                            full_path = path + [name]
+                            if log:
+                                log.debug('directory matched: %s %s' % (
+                                    repr(full_path), (repr([i[0] for i in six.iteritems(content)]) if content else None)))
+                            matched_directories.append(
+                                (full_path, submatcher, new_attributes))
+                        elif log:
                             log.debug(
-                                'try %s for %s' % (repr(pattern), repr(name_no_ext)))
-                        if match:
+                                'no directory matched for %s' % repr(name))
+                    else:
+                        matched = branch_matched = True
+                        if log:
+                            log.debug('extension matched: ' + repr(ext))
+                        for rule_attributes in ext_rules[ext]:
+                            yield_attributes = new_attributes.copy()
+                            yield_attributes.update(rule_attributes)
+                            stop_parsing = single_match or yield_attributes.pop(
+                                'fom_stop_parsing', False)
                             if log:
-                                log.debug('match ' + pattern)
-                            new_attributes = match.groupdict()
-                            new_attributes.update(pattern_attributes)
-
-                            rules = ext_rules.get(ext)
-                            if (subpattern and
-                                    not ext and
-                                    (st is None or
-                                     stat.S_ISDIR(st[0])) and
-                                    content is not None):
-                                matched = branch_matched = True
-                                stop_parsing = single_match
-                                full_path = path + [name]
-                                if log:
-                                    log.debug('directory matched: %s %s' % (
-                                        repr(full_path), (repr([i[0] for i in six.iteritems(content)]) if content else None)))
-                                matched_directories.append(
-                                    (full_path, subpattern, new_attributes))
-                            else:
-                                if log:
-                                    log.debug(
-                                        'no directory matched for %s' % repr(name))
-                            if rules is not None and ext:
-                                matched = branch_matched = True
-                                if log:
-                                    log.debug(
-                                        'extension matched: ' + repr(ext))
-                                for rule_attributes in rules:
-                                    yield_attributes = new_attributes.copy()
-                                    yield_attributes.update(rule_attributes)
-                                    stop_parsing = single_match or yield_attributes.pop(
-                                        'fom_stop_parsing', False)
-                                    if log:
-                                        log.debug(
-                                            '-> ' + '/'.join(path + [name]) + ' ' + repr(yield_attributes))
-                                    sent = True
-                                    yield path + [name], st, yield_attributes
-                                break
-                            else:
-                                if log:
-                                    log.debug(
-                                        'no extension matched: ' + repr(ext))
-                        if stop_parsing:
-                            break
+                                log.debug(
+                                    '-> ' + '/'.join(path + [name]) + ' ' + repr(yield_attributes))
+                            sent = True
+                            yield path + [name], st, yield_attributes
                     if stop_parsing:
                         break
                 if branch_matched:
-                    for full_path, subpattern, new_attributes in matched_directories:
+                    for full_path, submatcher, new_attributes in matched_directories:
                         if content:
                             recurse_parsing_list.append(
-                                (full_path, subpattern, new_attributes))
+                                (full_path, submatcher, new_attributes))
             if recurse_parsing_list:
-                for i in self._parse_directory(content, recurse_parsing_list, single_match, all_unknown, log):
-                    yield i
+                if shards is not None and depth <= 1:
+                    # leave the parsing of this subtree to a worker
+                    yield _ParsingShard(len(shards))
+                    shards.append((content, recurse_parsing_list))
+                else:
+                    for i in self._parse_directory(content, recurse_parsing_list, single_match, all_unknown, log,
+                                                   shards, depth - 1):
+                        yield i
             if not matched and all_unknown:
                 if log:
                     log.debug('-> ' + '/'.join(path + [name]) + ' None')
@@ -1043,6 +2565,190 @@ class PathToAttributes(object):
                     log.debug('-> ' + '/'.join(path + [name]) + ' None')
                 yield path + [name], st, None
 
+    def parse_filesystem(self, directory, single_match=False,
+                         all_unknown=False, cache=None, log=None):
+        '''
+        Parse the content of a directory of the filesystem, as
+        :meth:`parse_directory` does for a dict.
+
+        The filesystem is walked while it is parsed, using
+        :func:`os.scandir`: a directory is only listed if its name matches
+        a hierarchical pattern (with sub-patterns) at its depth, so
+        unmatched subtrees are never read unless all_unknown is True. Only
+        the directories being parsed are kept in memory. Yielded paths are
+        relative to directory.
+
+        cache may be a :class:`DirectoriesCache`: the content of the
+        directories it contains is read from it instead of the filesystem.
+        '''
+        if not osp.isdir(directory):
+            raise ValueError('%s is not a directory' % directory)
+        if cache is None:
+            cache = DirectoriesCache()
+        dirdict = DirectoryAsDict._subdirectory(directory, cache)
+        return self._parse_directory(dirdict, [([], self._matcher, {})],
+                                     single_match, all_unknown, log)
+
+    def parse_directory_parallel(self, dirdict, single_match=False,
+                                 all_unknown=False, nworker=0, depth=1,
+                                 ordered=True, log=None):
+        '''
+        Same as :meth:`parse_directory`, but the parsing of matched
+        directories is distributed over worker processes (see
+        :mod:`soma.mpfork2`).
+
+        Directories down to the given depth are parsed in the calling
+        process: each directory matched at this depth becomes a shard which
+        is parsed by a worker, using the same matchers. Each worker sends back
+        the list of (path, st, attributes) found in its shard as a batch.
+        Workers are forked once the shards are known, so dirdict does not
+        need to be picklable, but the results do.
+
+        Parameters
+        ----------
+        dirdict: dict or DirectoryAsDict
+            directory contents, as for :meth:`parse_directory`
+        nworker: int
+            number of worker processes, as in
+            :func:`soma.mpfork2.allocate_workers`: 0 means all available CPU
+            cores, a negative number means all cores but this number.
+        depth: int
+            depth (1 for the top-level matched directories) of the
+            directories parsed as shards.
+        ordered: bool
+            if True, the results are yielded in the same order as
+            :meth:`parse_directory` does. Otherwise the shards results are
+            yielded as soon as they are available, after the results of the
+            upper levels.
+        '''
+        if isinstance(dirdict, six.string_types):
+            dirdict = DirectoryAsDict.paths_to_dict(dirdict)
+        shards = []
+        parsed = list(self._parse_directory(
+            dirdict, [([], self._matcher, {})], single_match, all_unknown, log,
+            shards, depth))
+        if not shards:
+            for i in parsed:
+                yield i
+            return
+
+        from soma import mpfork2
+
+        jobs = queue.Queue()
+        results = _ShardResults()
+        workers = mpfork2.allocate_workers(
+            jobs, results, nworker, len(shards), self, shards, single_match,
+            all_unknown)
+        try:
+            for i in range(len(shards)):
+                jobs.put((i, _parse_shard, (i, ), {}))
+            for i in range(len(workers)):
+                jobs.put(None)
+            for worker in workers:
+                worker.start()
+            if ordered:
+                for i in parsed:
+                    if isinstance(i, _ParsingShard):
+                        for j in results.get_shard(i.index):
+                            yield j
+                    else:
+                        yield i
+            else:
+                for i in parsed:
+                    if not isinstance(i, _ParsingShard):
+                        yield i
+                for n in range(len(shards)):
+                    for j in results.get_shard():
+                        yield j
+        finally:
+            jobs.join()
+            for worker in workers:
+                if worker.thread is not None:
+                    worker.join()
+
+    def parse_directory_compact(self, dirdict, single_match=False,
+                                all_unknown=False, with_stat=False):
+        '''
+        Same as :meth:`parse_directory`, but return all the results at once
+        as a :class:`CompactParseResults`, which uses much less memory than
+        a list of the results of :meth:`parse_directory` for large trees.
+        If with_stat is False, stat results of entries are not kept.
+        '''
+        if isinstance(dirdict, six.string_types):
+            dirdict = DirectoryAsDict.paths_to_dict(dirdict)
+        results = CompactParseResults(with_stat)
+        self._parse_directory_compact(dirdict, 0, [(self._matcher, 0)],
+                                      single_match, all_unknown, results)
+        return results
+
+    def _parse_directory_compact(self, dirdict, parent_id, parsing_list,
+                                 single_match, all_unknown, results):
+        '''
+        Compact version of :meth:`_parse_directory`: parsing_list contains
+        (matcher, context_id) for the directory parent_id, and results are
+        added to results instead of being yielded.
+        '''
+        add = results._add
+        contexts = results.contexts
+        for name, content in six.iteritems(dirdict):
+            st, content = content
+            matched_directories = []
+            matched = False
+            sent = False
+            recurse_parsing_list = []
+            for matcher, context_id in parsing_list:
+                context = contexts[context_id]
+                branch_matched = False
+                for pattern, ext, ext_rules, submatcher, name_attributes \
+                        in matcher.match(name, context, self._compile):
+                    stop_parsing = False
+                    if not ext:
+                        if content is not None \
+                                and (st is None or _is_directory(st)):
+                            matched = branch_matched = True
+                            stop_parsing = single_match
+                            name_attributes.update(context)
+                            matched_directories.append(
+                                (submatcher, name_attributes))
+                    else:
+                        matched = branch_matched = True
+                        overlay = name_attributes or None
+                        for rule_attributes in ext_rules[ext]:
+                            stop_parsing = single_match or \
+                                rule_attributes.get('fom_stop_parsing', False)
+                            sent = True
+                            add(parent_id, name, st, context_id, overlay,
+                                results._rule_id(rule_attributes))
+                    if stop_parsing:
+                        break
+                if branch_matched:
+                    for submatcher, attributes in matched_directories:
+                        if content:
+                            recurse_parsing_list.append(
+                                (submatcher, results._add_context(attributes)))
+            if recurse_parsing_list:
+                self._parse_directory_compact(
+                    content, results._add_directory(parent_id, name),
+                    recurse_parsing_list, single_match, all_unknown, results)
+            if not matched and all_unknown:
+                sent = True
+                add(parent_id, name, st, -1, None, -1)
+                if content:
+                    self._parse_unknown_directory_compact(
+                        content, results._add_directory(parent_id, name),
+                        results)
+            if not sent and all_unknown:
+                add(parent_id, name, st, -1, None, -1)
+
+    def _parse_unknown_directory_compact(self, dirdict, parent_id, results):
+        for name, content in six.iteritems(dirdict):
+            st, content = content
+            results._add(parent_id, name, st, -1, None, -1)
+            if content is not None:
+                self._parse_unknown_directory_compact(
+                    content, results._add_directory(parent_id, name),
+                    results)
+
     def _parse_unknown_directory(self, dirdict, path, log):
         for name, content in six.iteritems(dirdict):
             st, content = content
@@ -1061,41 +2767,295 @@ class PathToAttributes(object):
                 yield (p, s, a)
 
 
+class MultiPathToAttributes(PathToAttributes):
+
+    '''
+    :class:`PathToAttributes` recognizing the files of several FOMs at
+    once.
+
+    foms_list is a list of :class:`FileOrganizationModels` (each one with
+    its own formats and attributes definitions). Their hierarchical patterns
+    are merged in a single tree, so that a directory tree mixing several
+    layouts is listed and matched only once. Each rule keeps the fom_name
+    attribute of the FOM it comes from, so results tell which FOM
+    recognized a file. A file recognized by several FOMs is yielded once
+    for each of them. Identical patterns of several FOMs are merged, so
+    with single_match, the rules of all the FOMs sharing the first matching
+    pattern (in the order of foms_list) are kept.
+    '''
+
+    def __init__(self, foms_list, selection=None, regex_cache_size=1024):
+        self.foms_list = list(foms_list)
+        self._build(self.foms_list, selection, regex_cache_size)
+
+
+class CompactParseResults(object):
+
+    '''
+    Results of :meth:`PathToAttributes.parse_directory_compact`.
+
+    Paths are stored as references to a directories table, and attributes
+    are not copied for each result:
+
+    - :attr:`directories` is the list of the (parent_id, name) of the
+      directories containing results (index 0 is the parsed directory).
+    - :attr:`rules` is the list of the rules attributes dicts found in
+      results. They are shared with the :class:`PathToAttributes` and must
+      not be modified.
+    - :attr:`contexts` is the list of the attributes dicts found in parent
+      directories names, shared by all the results of a directory.
+    - results are stored in columns: :attr:`parent_ids`,
+      :attr:`context_ids` and :attr:`rule_ids` are arrays of indices in
+      these tables (-1 for unknown entries), :attr:`names` is the list of
+      entry names, and :attr:`overlays` the list of attributes found in the
+      entry name (None if there are none). :attr:`stats` is the list of
+      stat results, or None if they are not kept.
+
+    The full attributes of a result are built by :meth:`attributes`.
+    Iterating over the object yields the (path, st, attributes) tuples
+    :meth:`PathToAttributes.parse_directory` would yield.
+    '''
+
+    def __init__(self, with_stat=False):
+        from array import array
+
+        self.directories = [(-1, '')]
+        self.rules = []
+        self._rule_ids = {}
+        self.contexts = [{}]
+        self.parent_ids = array('l')
+        self.context_ids = array('l')
+        self.rule_ids = array('l')
+        self.names = []
+        self.overlays = []
+        self.stats = ([] if with_stat else None)
+
+    def _add(self, parent_id, name, st, context_id, overlay, rule_id):
+        self.parent_ids.append(parent_id)
+        self.names.append(name)
+        self.context_ids.append(context_id)
+        self.overlays.append(overlay)
+        self.rule_ids.append(rule_id)
+        if self.stats is not None:
+            self.stats.append(st)
+
+    def _add_directory(self, parent_id, name):
+        self.directories.append((parent_id, name))
+        return len(self.directories) - 1
+
+    def _add_context(self, attributes):
+        self.contexts.append(attributes)
+        return len(self.contexts) - 1
+
+    def _rule_id(self, rule_attributes):
+        # rules dicts live as long as the PathToAttributes
+        rule_id = self._rule_ids.get(id(rule_attributes))
+        if rule_id is None:
+            rule_id = len(self.rules)
+            self.rules.append(rule_attributes)
+            self._rule_ids[id(rule_attributes)] = rule_id
+        return rule_id
+
+    def __len__(self):
+        return len(self.names)
+
+    def directory_path(self, directory_id):
+        '''
+        List of the names of a directory of :attr:`directories`.
+        '''
+        path = []
+        while directory_id > 0:
+            directory_id, name = self.directories[directory_id]
+            path.append(name)
+        path.reverse()
+        return path
+
+    def path(self, index):
+        '''
+        Path (list of names) of a result.
+        '''
+        return self.directory_path(self.parent_ids[index]) \
+            + [self.names[index]]
+
+    def attributes(self, index):
+        '''
+        New attributes dict of a result (None for unknown entries).
+        '''
+        rule_id = self.rule_ids[index]
+        if rule_id < 0:
+            return None
+        overlay = self.overlays[index]
+        attributes = (dict(overlay) if overlay else {})
+        attributes.update(self.contexts[self.context_ids[index]])
+        attributes.update(self.rules[rule_id])
+        attributes.pop('fom_stop_parsing', None)
+        return attributes
+
+    def __iter__(self):
+        directory_id = None
+        for index in range(len(self.names)):
+            if self.parent_ids[index] != directory_id:
+                directory_id = self.parent_ids[index]
+                directory_path = self.directory_path(directory_id)
+            yield (directory_path + [self.names[index]],
+                   (None if self.stats is None else self.stats[index]),
+                   self.attributes(index))
+
+    def numpy_columns(self):
+        '''
+        Return the parent_ids, context_ids and rule_ids columns as numpy
+        arrays sharing the memory of the columns.
+        '''
+        import numpy as np
+
+        return dict((name, np.frombuffer(getattr(self, name), dtype='l'))
+                    for name in ('parent_ids', 'context_ids', 'rule_ids'))
+
+
+class _ParsingShard(object):
+
+    '''
+    Placeholder yielded by :meth:`PathToAttributes._parse_directory` for a
+    directory the parsing of which is left to a worker.
+    '''
+
+    def __init__(self, index):
+        self.index = index
+
+
+class _ShardResults(object):
+
+    '''
+    Results "list" of :meth:`PathToAttributes.parse_directory_parallel`
+    workers: results are queued as they are set by the workers threads, and
+    retrieved using :meth:`get_shard`.
+    '''
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._pending = {}
+
+    def __setitem__(self, index, value):
+        self._queue.put((index, value))
+
+    def get_shard(self, index=None):
+        '''
+        Wait for the results of the given shard, or of any shard if index is
+        None, and return them. Raise the worker exception, if any.
+        '''
+        if index is None and self._pending:
+            index = next(iter(self._pending))
+        while index is None or index not in self._pending:
+            i, value = self._queue.get()
+            self._pending[i] = value
+            if index is None:
+                index = i
+        value = self._pending.pop(index)
+        if isinstance(value, tuple) and len(value) == 3 \
+                and isinstance(value[1], Exception):
+            six.reraise(*value)
+        return value
+
+
+def _parse_shard(path_to_attributes, shards, single_match, all_unknown,
+                 index):
+    content, parsing_list = shards[index]
+    return list(path_to_attributes._parse_directory(
+        content, parsing_list, single_match, all_unknown, None))
+
+
+def _sqlite_sort_key(value):
+    '''
+    Sort key ordering values like sqlite does: NULL, numbers, text then
+    blobs.
+    '''
+    if value is None:
+        return (0,)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, six.string_types):
+        return (2, value)
+    return (3, value)
+
+
 class AttributesToPaths(object):
 
     '''
     Utility class for attributes set -> file paths transformation.
     Part of the FOM engine.
+
+    Results of :meth:`find_paths` are cached for the
+    find_paths_cache_size (0 to disable the cache) last attributes sets
+    used. The cache is cleared when :attr:`selection` or
+    :attr:`directories` are modified.
+
+    Rules are indexed by the engine given at construction:
+
+    - ``'sqlite'`` (the default) stores them in an in-memory sqlite
+      table with an index for each attribute column.
+    - ``'bitset'`` keeps, for each attribute and each of its values
+      (including the empty string and None wildcards), the set of
+      matching rules as an integer bitset. A selection is answered by
+      combining these bitsets.
+
+    Both engines give the same results.
+
+    If cache_directory is given, the sqlite engine rules table is saved
+    in this directory, in a file whose name is a hash of the FOMs content,
+    the selection and the preferred formats. Later instances built with
+    the same parameters (including in other processes) open this file
+    read-only instead of rebuilding the table.
+
+    :meth:`find_existing_paths` checks the existence of the generated paths
+    in the listings of their parent directories. The last
+    listing_cache_size listings are kept for listing_cache_ttl seconds.
+
+    :attr:`construction_time` is the time (in seconds) spent building (or
+    loading) the rules index. It is also logged by debug if given.
     '''
 
-    def __init__(self, foms, selection=None, directories={}, preferred_formats=set(), debug=None):
+    engines = ('sqlite', 'bitset')
+    rules_cache_version = 1
+
+    def __init__(self, foms, selection=None, directories={}, preferred_formats=set(), debug=None,
+                 find_paths_cache_size=256, engine='sqlite',
+                 cache_directory=None, listing_cache_ttl=5.0,
+                 listing_cache_size=1024):
+        if engine not in self.engines:
+            raise ValueError('Invalid AttributesToPaths engine: %s'
+                             % repr(engine))
+        start_time = time.time()
         self.foms = foms
         self.selection = selection or {}
         self.directories = directories
-        self._db = sqlite3.connect(':memory:', check_same_thread=False)
-        self._db.execute('PRAGMA journal_mode = OFF;')
-        self._db.execute('PRAGMA synchronous = OFF;')
+        self.engine = engine
+        self.listing_cache_ttl = listing_cache_ttl
+        self._listing_cache = _LRUCache(listing_cache_size)
+        self._find_paths_cache = _LRUCache(find_paths_cache_size)
+        self._find_paths_cache_state = None
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._attributes_values_cache = _LRUCache(128)
+        self._bitsets = None
+        # rules of lazily loaded processes must exist before attributes
+        # are listed
+        foms.expand_processes(self.selection)
         self.all_attributes = tuple(
             i for i in self.foms.attribute_definitions if i != 'fom_formats')
         self.default_values = dict(
             (i, self.foms.attribute_definitions[i]['default_value']) for i in self.all_attributes if 'default_value' in self.foms.attribute_definitions[i])
         self.non_discriminant_attributes = set(
             i for i in self.all_attributes if not self.foms.attribute_definitions[i].get('discriminant', True))
+        rules_cache = None
+        if cache_directory and engine == 'sqlite':
+            rules_cache = osp.join(
+                cache_directory, 'fom_rules_%s.sqlite'
+                % self._rules_cache_key(preferred_formats))
+            if self._open_rules_cache(rules_cache, debug):
+                self._set_construction_time(start_time, debug)
+                return
         fom_format_index = self.all_attributes.index('fom_format')
-        sql = 'CREATE TABLE rules ( %s, _fom_first, _fom_preferred_format, _fom_rule )' % ','.join(repr('_' + str(i))
-                                for i in self.all_attributes)
-        if debug:
-            debug.debug(sql)
-        self._db.execute(sql)
-        columns = ['_%s' %
-                   i for i in self.all_attributes + ('fom_first', 'fom_preferred_format')]
-        sql = 'CREATE INDEX rules_index ON rules (%s)' % ','.join(columns)
-        self._db.execute(sql)
-        for i in columns:
-            sql = 'CREATE INDEX rules%s_index ON rules (%s)' % (i, i)
-            self._db.execute(sql)
-        sql_insert = 'INSERT INTO rules VALUES ( %s )' % ','.join(
-            '?' for i in range(len(self.all_attributes) + 3))
+        rows = []
         self.rules = []
         for pattern, rule_attributes in foms.selected_rules(self.selection, debug=debug):
             if debug:
@@ -1123,29 +3083,518 @@ class AttributesToPaths(object):
                         break
                 else:
                     preferred_format = fom_formats[0]
-                sys.stdout.flush()
                 for format in fom_formats:
                     values[fom_format_index] = format
                     values[-3] = first
                     values[-2] = bool(format == preferred_format)
                     first = False
-                    if debug:
-                        debug.debug(sql_insert + ' ' + repr(values))
-                    self._db.execute(sql_insert, values)
+                    rows.append(tuple(values))
             else:
-                if debug:
-                    debug.debug(sql_insert + ' ' + repr(values))
-                self._db.execute(sql_insert, values)
-        self._db.commit()
+                rows.append(tuple(values))
+        if engine == 'sqlite':
+            self._create_db(rows, debug)
+            if rules_cache:
+                self._save_rules_cache(rules_cache, debug)
+        else:
+            self._create_bitsets(rows)
+        self._set_construction_time(start_time, debug, len(rows))
+
+    def _set_construction_time(self, start_time, debug, rows=None):
+        self.construction_time = time.time() - start_time
+        if debug:
+            if rows is None:
+                debug.debug('rules index loaded in %.3fs'
+                            % self.construction_time)
+            else:
+                debug.debug('rules index of %d rows built in %.3fs'
+                            % (rows, self.construction_time))
+
+    def _rules_cache_key(self, preferred_formats):
+        '''
+        Hash identifying the rules table built for the current FOMs,
+        selection and preferred_formats.
+        '''
+        content = json.dumps([self.rules_cache_version, self.foms.fom_names,
+                              self.all_attributes, self.foms.rules,
+                              self.selection, sorted(preferred_formats)],
+                             sort_keys=True, default=repr)
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def _open_rules_cache(self, path, debug=None):
+        '''
+        Open a rules table saved by :meth:`_save_rules_cache` read-only.
+        Return False if it does not exist or cannot be read.
+        '''
+        if not osp.exists(path):
+            return False
+        try:
+            db = sqlite3.connect(
+                'file:%s?mode=ro' % six.moves.urllib.parse.quote(path),
+                uri=True, check_same_thread=False)
+            rules = [(pattern, json.loads(attributes))
+                     for pattern, attributes in db.execute(
+                         'SELECT pattern, attributes FROM patterns '
+                         'ORDER BY _fom_rule')]
+        except sqlite3.DatabaseError as e:
+            if debug:
+                debug.debug('cannot read rules cache %s: %s' % (path, e))
+            return False
+        if debug:
+            debug.debug('rules cache: %s' % path)
+        self._db = db
+        self.rules = rules
+        return True
+
+    def _save_rules_cache(self, path, debug=None):
+        '''
+        Save the rules table and the rules patterns in path. The file is
+        written under a temporary name then renamed, so that concurrent
+        processes never see a partial file.
+        '''
+        directory = osp.dirname(path)
+        try:
+            if not osp.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp_path = tempfile.mkstemp(dir=directory,
+                                            suffix='.sqlite.tmp')
+            os.close(fd)
+            try:
+                db = sqlite3.connect(tmp_path)
+                try:
+                    self._db.backup(db)
+                    db.execute('CREATE TABLE patterns '
+                               '( _fom_rule INTEGER PRIMARY KEY, pattern, '
+                               'attributes )')
+                    db.executemany(
+                        'INSERT INTO patterns VALUES ( ?, ?, ? )',
+                        ((i, pattern, json.dumps(attributes))
+                         for i, (pattern, attributes)
+                         in enumerate(self.rules)))
+                    db.commit()
+                finally:
+                    db.close()
+                os.rename(tmp_path, path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+        except (OSError, IOError, sqlite3.DatabaseError, TypeError,
+                ValueError) as e:
+            # the cache is an optimization: failing to write it (including
+            # rules attributes which cannot be saved as JSON) is not an
+            # error
+            if debug:
+                debug.debug('cannot write rules cache %s: %s' % (path, e))
+
+    def _create_db(self, rows, debug=None):
+        '''
+        Create the sqlite rules table for the sqlite engine.
+        '''
+        self._db = sqlite3.connect(':memory:', check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode = OFF;')
+        self._db.execute('PRAGMA synchronous = OFF;')
+        sql = 'CREATE TABLE rules ( %s, _fom_first, _fom_preferred_format, _fom_rule )' % ','.join(repr('_' + str(i))
+                                for i in self.all_attributes)
+        if debug:
+            debug.debug(sql)
+        self._db.execute(sql)
+        sql_insert = 'INSERT INTO rules VALUES ( %s )' % ','.join(
+            '?' for i in range(len(self.all_attributes) + 3))
+        if debug:
+            for values in rows:
+                debug.debug(sql_insert + ' ' + repr(values))
+        # bulk insertion in a single transaction, then indexes creation
+        # (cheaper than updating all the indexes for each row)
+        with self._db:
+            self._db.executemany(sql_insert, rows)
+            columns = ['_%s' %
+                       i for i in self.all_attributes + ('fom_first', 'fom_preferred_format')]
+            sql = 'CREATE INDEX rules_index ON rules (%s)' % ','.join(columns)
+            self._db.execute(sql)
+            for i in columns:
+                sql = 'CREATE INDEX rules%s_index ON rules (%s)' % (i, i)
+                self._db.execute(sql)
+
+    def _create_bitsets(self, rows):
+        '''
+        Create the rules index of the bitset engine. Rows are kept as tuples
+        ordered like the sqlite table columns.
+        '''
+        # sqlite stores booleans as integers
+        rows = [tuple((int(value) if isinstance(value, bool) else value)
+                      for value in values) for values in rows]
+        self._rows = rows
+        self._index_bitsets(rows)
+
+    def _index_bitsets(self, rows):
+        '''
+        Build, for each column, a dict mapping each value to the bitset of
+        the rows having this value.
+        '''
+        columns = self.all_attributes + ('fom_first', 'fom_preferred_format')
+        self._all_rows_mask = (1 << len(rows)) - 1
+        self._columns_index = dict((column, i)
+                                   for i, column in enumerate(columns))
+        self._bitsets = dict((column, {}) for column in columns)
+        if not rows:
+            return
+        size = (len(rows) + 7) // 8
+        for column, column_values in zip(columns, zip(*rows)):
+            bitsets = self._bitsets[column]
+            # the most frequent value bitset is deduced from the others
+            counts = Counter(column_values)
+            frequent_value = max(counts, key=counts.get)
+            indices = {}
+            for i in itertools.compress(
+                    range(len(column_values)),
+                    map(operator.ne, column_values,
+                        itertools.repeat(frequent_value))):
+                indices.setdefault(column_values[i], []).append(i)
+            others_mask = 0
+            for value, value_indices in six.iteritems(indices):
+                # or-ing bits one by one in growing integers would be
+                # quadratic
+                bitmap = bytearray(size)
+                for i in value_indices:
+                    bitmap[i >> 3] |= 1 << (i & 7)
+                bitset = int.from_bytes(bytes(bitmap), 'little')
+                bitsets[value] = bitset
+                others_mask |= bitset
+            bitsets[frequent_value] = self._all_rows_mask & ~others_mask
+
+    def _bitset_mask(self, conditions):
+        '''
+        Return the bitset of the rows matching all conditions given as
+        returned by :meth:`_selection_query`.
+        '''
+        mask = self._all_rows_mask
+        for column, values, negate, with_null in conditions:
+            bitsets = self._bitsets[column]
+            column_mask = 0
+            for value in values:
+                column_mask |= bitsets.get(value, 0)
+            if negate:
+                column_mask = self._all_rows_mask & ~column_mask
+            elif with_null:
+                column_mask |= bitsets.get(None, 0)
+            mask &= column_mask
+            if not mask:
+                break
+        return mask
+
+    @staticmethod
+    def _bitset_indices(mask):
+        '''
+        Iterate over the indices of the bits set in mask, in increasing
+        order.
+        '''
+        while mask:
+            low_bit = mask & -mask
+            yield low_bit.bit_length() - 1
+            mask ^= low_bit
+
+    def _equality_mask(self, selection):
+        mask = self._all_rows_mask
+        for attribute, value in six.iteritems(selection):
+            if value is None:
+                # like "= NULL" in SQL
+                return 0
+            mask &= self._bitsets[attribute].get(value, 0)
+        return mask
+
+    @staticmethod
+    def _sql_conditions(conditions):
+        '''
+        Convert conditions returned by :meth:`_selection_query` to a list
+        of SQL expressions and the list of their parameters.
+        '''
+        select = []
+        values = []
+        for column, column_values, negate, with_null in conditions:
+            sql = '_%s %sIN ( %s )' % (column, ('NOT ' if negate else ''),
+                                       ','.join('?' for i in column_values))
+            if negate or with_null:
+                sql = '(%s OR _%s IS NULL )' % (sql, column)
+            select.append(sql)
+            values.extend(column_values)
+        return select, values
 
     def find_paths(self, attributes={}, debug=None):
+        '''
+        Iterate over the (path, attributes) matching the given attributes,
+        completed by :attr:`selection`.
+        '''
+        if debug or self._find_paths_cache.maxsize == 0:
+            return self._find_paths(attributes, debug)
+        try:
+            key = _freeze(attributes)
+            self._check_find_paths_cache()
+        except TypeError:
+            # unhashable attributes values
+            return self._find_paths(attributes, debug)
+        result = self._find_paths_cache.get(key)
+        if result is None:
+            result = list(self._find_paths(attributes))
+            self._find_paths_cache.put(key, result)
+        return ((path, path_attributes.copy())
+                for path, path_attributes in result)
+
+    def _check_find_paths_cache(self):
+        state = (_freeze(self.selection), _freeze(self.directories))
+        if state != self._find_paths_cache_state:
+            self._find_paths_cache.clear()
+            self._find_paths_cache_state = state
+
+    def find_paths_many(self, attributes_list, debug=None):
+        '''
+        Batch version of :meth:`find_paths`: return a list containing, for
+        each attributes dict of attributes_list, the list of (path,
+        attributes) that :meth:`find_paths` gives for it.
+
+        Selections are loaded in a temporary table, and resolved with one
+        join query against the rules table for each group of selections
+        giving values to the same attributes. Selections using lists of
+        values, and all selections with the bitset engine, are resolved
+        one by one. The :meth:`find_paths` cache is
+        used and filled as well.
+        '''
+        results = [None] * len(attributes_list)
+        use_cache = not debug and self._find_paths_cache.maxsize != 0
+        if use_cache:
+            try:
+                self._check_find_paths_cache()
+            except TypeError:
+                use_cache = False
+        groups = OrderedDict()
+        for index, attributes in enumerate(attributes_list):
+            key = None
+            if use_cache:
+                try:
+                    key = _freeze(attributes)
+                except TypeError:
+                    pass
+                else:
+                    result = self._find_paths_cache.get(key)
+                    if result is not None:
+                        results[index] = [(path, path_attributes.copy())
+                                          for path, path_attributes
+                                          in result]
+                        continue
+            shape = None
+            if self.engine == 'sqlite':
+                # the bitset engine has no per-query overhead to share
+                query = self._selection_query(attributes)
+                shape = self._selection_shape(query[0])
+            if shape is None:
+                result = list(self._find_paths(attributes, debug))
+            else:
+                groups.setdefault(shape, []).append(
+                    (index, key, query))
+                continue
+            if key is not None:
+                self._find_paths_cache.put(key, result)
+            results[index] = [(path, path_attributes.copy())
+                              for path, path_attributes in result]
+        for shape, selections in six.iteritems(groups):
+            for index, key, result in self._find_paths_group(
+                    shape, selections, debug):
+                if key is not None:
+                    self._find_paths_cache.put(key, result)
+                    result = [(path, path_attributes.copy())
+                              for path, path_attributes in result]
+                results[index] = result
+        return results
+
+    def _selection_shape(self, attributes):
+        '''
+        Return a tuple telling, for each attribute, if attributes gives it
+        a value (True), no value (None), or 'fom_first' / 'fom_preferred'
+        for fom_format. Return None if some values are lists.
+        '''
+        shape = []
+        for attribute in self.all_attributes:
+            value = attributes.get(attribute)
+            if isinstance(value, list):
+                return None
+            if value is None:
+                shape.append(None)
+            elif attribute == 'fom_format' \
+                    and value in ('fom_first', 'fom_preferred'):
+                shape.append(value)
+            else:
+                shape.append(True)
+        return tuple(shape)
+
+    def _find_paths_group(self, shape, selections, debug):
+        '''
+        Resolve selections (index, cache key, _selection_query() result)
+        which all give a value to the same attributes (shape) with a single
+        join query. Yield (index, cache key, results) for each selection.
+        '''
+        given = [attribute for attribute, value
+                 in zip(self.all_attributes, shape) if value is True]
+        default_attributes = [attribute for attribute in self.all_attributes
+                              if attribute in self.default_values]
+        default_index = dict((attribute, i)
+                             for i, attribute in enumerate(default_attributes))
+        conditions = []
+        values = []
+        for attribute, value in zip(self.all_attributes, shape):
+            column = 'rules._' + attribute
+            if value is True:
+                if attribute == 'fom_format':
+                    conditions.append('%s = selections._%s'
+                                      % (column, attribute))
+                elif attribute not in self.non_discriminant_attributes:
+                    conditions.append("%s IN ( selections._%s, '' )"
+                                      % (column, attribute))
+            elif value == 'fom_first':
+                conditions.append('rules._fom_first = 1')
+            elif value == 'fom_preferred':
+                conditions.append('rules._fom_preferred_format = 1')
+            elif attribute not in self.non_discriminant_attributes:
+                default_value = self.default_values.get(attribute)
+                if default_value is not None:
+                    conditions.append("(%s IN ('', ?) OR %s IS NULL )"
+                                      % (column, column))
+                    values.append('%s' % default_value)
+                else:
+                    conditions.append("(%s != '' OR %s IS NULL )"
+                                      % (column, column))
+        # the connection may be shared by several threads, which must not
+        # use the selections table at the same time
+        with self._db_lock:
+            self._db.execute(
+                'CREATE TEMP TABLE selections ( _fom_selection%s )'
+                % ''.join(', _' + attribute for attribute in given))
+            try:
+                self._db.executemany(
+                    'INSERT INTO selections VALUES ( %s )'
+                    % ','.join('?' for i in range(len(given) + 1)),
+                    ([i] + [query[0][attribute] for attribute in given]
+                     for i, (index, key, query) in enumerate(selections)))
+                columns = ['selections._fom_selection', 'rules._fom_rule',
+                           'rules._fom_format'] \
+                    + ['rules._' + attribute
+                       for attribute in default_attributes]
+                sql = 'SELECT %s FROM selections JOIN rules ON %s ' \
+                    'ORDER BY selections._fom_selection' \
+                    % (','.join(columns), ' AND '.join(conditions) or '1')
+                if debug:
+                    debug.debug('!sql! %s' % sql)
+                rows = self._db.execute(sql, values).fetchall()
+            finally:
+                self._db.execute('DROP TABLE selections')
+        row_index = 0
+        for i, (index, key, query) in enumerate(selections):
+            attributes, conditions, selection_attributes, default_values \
+                = query
+            positions = [3 + default_index[attribute]
+                         for attribute, default_value in default_values]
+            selection_rows = []
+            while row_index < len(rows) and rows[row_index][0] == i:
+                row = rows[row_index]
+                selection_rows.append(
+                    row[1:3] + tuple(row[p] for p in positions))
+                row_index += 1
+            yield index, key, list(self._rows_paths(
+                selection_rows, attributes, selection_attributes,
+                default_values, debug))
+
+    def find_paths_cache_info(self):
+        '''
+        Return a dict with the hits, misses, size and maxsize of the
+        :meth:`find_paths` results cache.
+        '''
+        return self._find_paths_cache.info()
+
+    def clear_find_paths_cache(self):
+        self._find_paths_cache.clear()
+
+    def find_existing_paths(self, attributes={}, annotate=False,
+                            debug=None):
+        '''
+        Iterate over the (path, attributes) of :meth:`find_paths` whose path
+        exists. If annotate is True, all the paths are given, as
+        (path, attributes, exists) tuples.
+
+        Each parent directory is listed once instead of calling stat for
+        each path. Listings are reused during listing_cache_ttl seconds
+        (see :meth:`clear_listing_cache`).
+        '''
+        now = time.time()
+        for path, path_attributes in self.find_paths(attributes, debug):
+            exists = self._path_exists(path, now)
+            if annotate:
+                yield path, path_attributes, exists
+            elif exists:
+                yield path, path_attributes
+
+    def _path_exists(self, path, now):
+        directory, name = osp.split(path)
+        names = self._directory_listing(directory, now)
+        if names is None:
+            return osp.exists(path)
+        return name in names
+
+    def _directory_listing(self, directory, now):
+        listing = self._listing_cache.get(directory)
+        if listing is not None and now - listing[0] <= self.listing_cache_ttl:
+            return listing[1]
+        try:
+            names = frozenset(os.listdir(directory or os.curdir))
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                names = frozenset()
+            else:
+                # the directory cannot be listed: fall back to stat
+                names = None
+        self._listing_cache.put(directory, (now, names))
+        return names
+
+    def clear_listing_cache(self):
+        self._listing_cache.clear()
+
+    def _find_paths(self, attributes={}, debug=None):
         if debug:
             debug.debug('!find_path! %s' % repr(attributes))
+        attributes, conditions, selection_attributes, default_values \
+            = self._selection_query(attributes)
+        if self.engine == 'bitset':
+            mask = self._bitset_mask(conditions)
+            columns = [self._columns_index[i[0]] for i in default_values]
+            fom_format_index = self._columns_index['fom_format']
+            rows = ((self._rows[i][-1], self._rows[i][fom_format_index])
+                    + tuple(self._rows[i][j] for j in columns)
+                    for i in self._bitset_indices(mask))
+        else:
+            select, values = self._sql_conditions(conditions)
+            columns = ['_fom_rule', '_fom_format'] + ['_' + i[0]
+                                                      for i in default_values]
+            sql = 'SELECT %s FROM rules WHERE %s' % (','.join(columns), ' AND '.join(
+                select))
+            if debug:
+                debug.debug('!sql! %s' %
+                            (sql.replace('?', '%s') % tuple(repr(i) for i in values)))
+            with self._db_lock:
+                rows = self._db.execute(sql, values).fetchall()
+        for r in self._rows_paths(rows, attributes, selection_attributes,
+                                  default_values, debug):
+            yield r
+
+    def _selection_query(self, attributes):
+        '''
+        Complete attributes with the selection, and build the conditions
+        selecting the matching rules. Return a tuple (attributes,
+        conditions, selection_attributes, default_values): conditions is a
+        list of (column, values, negate, with_null) meaning that the column
+        value must be (or must not be if negate is True) in values, or be
+        NULL if with_null is True. default_values is a list of (attribute,
+        default_value) for attributes without a value.
+        '''
         d = self.selection.copy()
         d.update(attributes)
         attributes = d
-        select = []
-        values = []
+        conditions = []
         selection_attributes = {}
         default_values = []
         for attribute in self.all_attributes:
@@ -1157,43 +3606,40 @@ class AttributesToPaths(object):
                 if default_value is not None:
                     default_values.append((attribute, default_value))
                     if attribute not in self.non_discriminant_attributes:
-                        select.append(
-                            '(_' + attribute + " IN ('','%s') OR _" % default_value + attribute + ' IS NULL )')
+                        conditions.append(
+                            (attribute, ('', '%s' % default_value), False,
+                             True))
                 else:
                     if attribute not in self.non_discriminant_attributes:
-                        select.append(
-                            '(_' + attribute + " != '' OR _" + attribute + ' IS NULL )')
+                        conditions.append((attribute, ('',), True, True))
             elif attribute == 'fom_format':
                 selected_format = attributes.get('fom_format')
                 if selected_format == 'fom_first':
-                    select.append('_fom_first = 1')
+                    conditions.append(('fom_first', (1,), False, False))
                 elif selected_format == 'fom_preferred':
-                    select.append('_fom_preferred_format = 1')
+                    conditions.append(
+                        ('fom_preferred_format', (1,), False, False))
                 elif isinstance(value, list):
-                    select.append('_' + attribute + " IN (%s)" %
-                                  ','.join('?' for i in value))
-                    values.extend(value)
+                    conditions.append((attribute, tuple(value), False, False))
                 else:
-                    select.append('_' + attribute + " = ?")
-                    values.append(value)
+                    conditions.append((attribute, (value,), False, False))
             elif isinstance(value, list):
                 if attribute not in self.non_discriminant_attributes:
-                    select.append('_' + attribute + " IN ( %s, '' )" %
-                                  ','.join('?' for i in value))
-                    values.extend(value)
+                    conditions.append(
+                        (attribute, tuple(value) + ('',), False, False))
             else:
                 if attribute not in self.non_discriminant_attributes:
-                    select.append('_' + attribute + " IN ( ?, '' )")
-                    values.append(value)
+                    conditions.append((attribute, (value, ''), False, False))
                     selection_attributes[attribute] = value
-        columns = ['_fom_rule', '_fom_format'] + ['_' + i[0]
-                                                  for i in default_values]
-        sql = 'SELECT %s FROM rules WHERE %s' % (','.join(columns), ' AND '.join(
-            select))
-        if debug:
-            debug.debug('!sql! %s' %
-                        (sql.replace('?', '%s') % tuple(repr(i) for i in values)))
-        for row in self._db.execute(sql, values):
+        return attributes, conditions, selection_attributes, default_values
+
+    def _rows_paths(self, rows, attributes, selection_attributes,
+                    default_values, debug=None):
+        '''
+        Iterate over the (path, attributes) built from rules table rows
+        (rule index, format, values of default_values attributes).
+        '''
+        for row in rows:
             rule_index, format = row[:2]
             row = row[2:]
             # bool_output = False
@@ -1273,18 +3719,47 @@ class AttributesToPaths(object):
                             debug.debug('!-->! %s' % repr(r))
                         yield r
 
+    def _attributes_values(self, selection):
+        '''
+        Distinct values of all attributes among the rules whose attributes
+        are equal to selection values, as a dict {attribute: sorted list of
+        1-element tuples (like sqlite rows)}. Values are read from the
+        per-attribute values bitsets (built from the rules table on first
+        use with the sqlite engine) and memoized per selection.
+        '''
+        try:
+            key = _freeze(selection)
+        except TypeError:
+            key = None
+        else:
+            result = self._attributes_values_cache.get(key)
+            if result is not None:
+                return result
+        # the rules connection may be shared by several threads, and the
+        # bitsets must not be seen before they are complete
+        with self._db_lock:
+            if self._bitsets is None:
+                self._index_bitsets(self._db.execute(
+                    'SELECT %s FROM rules' % ','.join(
+                        '"_%s"' % column for column in self.all_attributes
+                        + ('fom_first', 'fom_preferred_format'))).fetchall())
+        mask = self._equality_mask(selection)
+        result = {}
+        for attribute in self.all_attributes:
+            result[attribute] = sorted(
+                ((value,) for value, bitset
+                 in six.iteritems(self._bitsets[attribute]) if bitset & mask),
+                key=lambda row: _sqlite_sort_key(row[0]))
+        if key is not None:
+            self._attributes_values_cache.put(key, result)
+        return result
+
     def find_discriminant_attributes(self, **selection):
         result = []
         if self.rules:
+            attributes_values = self._attributes_values(selection)
             for attribute in self.all_attributes:
-                sql = 'SELECT DISTINCT "%s" FROM rules' % ('_' + attribute)
-                if selection:
-                    sql += ' WHERE ' + \
-                        ' AND '.join('_' + i + ' = ?' for i in selection)
-                    values = list(self._db.execute(sql,
-                                                   list(selection.values())))
-                else:
-                    values = list(self._db.execute(sql))
+                values = attributes_values[attribute]
                 if values and (len(values) > 1 or ('',) in values):
                     result.append(attribute)
         return result
@@ -1292,16 +3767,9 @@ class AttributesToPaths(object):
     def find_attributes_values(self, **selection):
         result = {}
         if self.rules:
-            for attribute in self.all_attributes:
-                sql = 'SELECT DISTINCT "%s" FROM rules' % ('_' + attribute)
-                if selection:
-                    sql += ' WHERE ' + \
-                        ' AND '.join('_' + i + ' = ?' for i in selection)
-                    values = list(self._db.execute(sql,
-                                                   list(selection.values())))
-                else:
-                    values = list(self._db.execute(sql))
-                result[attribute] = values
+            for attribute, values in six.iteritems(
+                    self._attributes_values(selection)):
+                result[attribute] = list(values)
         return result
 
     def _join_directory(self, path, rule_attributes, selection_attributes):
@@ -1362,11 +3830,17 @@ class AttributesToPaths(object):
 
 
 def call_before_application_initialization(application):
-    from traits.api import List
+    from traits.api import List, Str
 
     application.add_trait(
         'fom_path',
         List(str, descr='Path for finding file organization models'))
+    application.add_trait(
+        'fom_cache_directory',
+        Str(descr='Directory where the FOM registry and the loaded FOMs '
+            'bundles are cached, for instance ~/.cache/soma/fom. It must '
+            'only be writable by trusted users since bundles are unpickled '
+            'from it (no cache if empty, the default)'))
     # find initial paths: look for a build path, an install path
     d = osp.dirname(osp.dirname(__file__))
     if osp.basename(d) in ('site-packages', 'dist-packages'):
@@ -1385,7 +3859,8 @@ def call_before_application_initialization(application):
 
 def call_after_application_initialization(application):
     application.fom_manager = FileOrganizationModelManager(
-        application.fom_path)
+        application.fom_path,
+        cache_directory=application.fom_cache_directory or None)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,598 @@
+# -*- coding: utf-8 -*-
+
+'''
+Indexes of the files of a directory tree organized according to a File
+Organization Model (FOM), see :mod:`soma.fom`.
+
+:class:`FomLiveIndex` parses a directory with a
+:class:`~soma.fom.PathToAttributes` once, then follows the changes of the
+parsed tree using Linux inotify events, so that queries always see the
+current state of the filesystem without parsing it again::
+
+    pta = PathToAttributes(foms)
+    with FomLiveIndex(pta, '/data/archive') as index:
+        for path, attributes in index.find(subject='s1',
+                                           fom_parameter='t1mri'):
+            print(path)
+
+:class:`FomDatabase` stores parsing results in a sqlite database file, with
+an indexed column per attribute, to query large archives without parsing
+them again::
+
+    with FomDatabase('/data/archive_index.sqlite') as db:
+        db.update(pta.parse_filesystem('/data/archive'))
+        for path, attributes in db.find(subject=['s1', 's2'],
+                                        fom_parameter='t1mri'):
+            print(path)
+'''
+
+from __future__ import absolute_import
+
+import os
+import os.path as osp
+import errno
+import struct
+import select
+import sqlite3
+import itertools
+
+import six
+
+from soma.fom import DirectoryAsDict, DirectoriesCache
+
+
+class _Inotify(object):
+
+    '''
+    Minimal inotify wrapper using ctypes (Linux only).
+    '''
+
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    _event_header = struct.Struct('iIII')
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        libc_name = ctypes.util.find_library('c')
+        try:
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            self._init1 = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self._ctypes = ctypes
+        self.fd = self._init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise_errno()
+
+    def _raise_errno(self, path=None):
+        error = self._ctypes.get_errno()
+        raise OSError(error, os.strerror(error), path)
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            self._raise_errno(path)
+        return wd
+
+    def rm_watch(self, wd):
+        # fails if the watch has already been removed by the kernel
+        self._rm_watch(self.fd, wd)
+
+    def read_events(self, timeout=0):
+        '''
+        Return the list of pending (wd, mask, cookie, name) events, waiting
+        at most timeout seconds (None to wait forever) for the first one.
+        '''
+        if timeout != 0:
+            ready = select.select([self.fd], [], [], timeout)[0]
+            if not ready:
+                return []
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = self._event_header.unpack_from(
+                    data, offset)
+                offset += self._event_header.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class _ListedDirectoriesCache(DirectoriesCache):
+
+    '''
+    Empty :class:`~soma.fom.DirectoriesCache` recording the directories
+    listed by :class:`_RecordingDirectory` objects.
+    '''
+
+    def __init__(self):
+        super(_ListedDirectoriesCache, self).__init__()
+        self.listed = []
+
+
+class _RecordingDirectory(DirectoryAsDict):
+
+    '''
+    :class:`~soma.fom.DirectoryAsDict` recording in its cache the
+    directories actually listed during a parsing.
+    '''
+
+    def iteritems(self):
+        self.cache.listed.append(self.directory)
+        return super(_RecordingDirectory, self).iteritems()
+
+
+class FomLiveIndex(object):
+
+    '''
+    In-memory attributes -> paths index of a directory tree, kept up to
+    date with inotify (Linux only).
+
+    The directory is parsed once, walking the filesystem as
+    :meth:`~soma.fom.PathToAttributes.parse_filesystem` does, and every
+    directory listed by the parser is watched. When an entry is created, moved or
+    deleted in a watched directory, only the subtree of this entry is parsed
+    again and updated in the index. Events are processed when the index is
+    queried (or by calling :meth:`process_events` explicitly), so queries
+    always see the current state of the filesystem. Use :meth:`fileno` to
+    wait for events in an event loop.
+
+    Paths are relative to the indexed directory, using "/" as separator.
+    Changes of files content are not followed, only the creation, removal
+    and renaming of entries.
+    '''
+
+    watch_mask = (_Inotify.IN_CREATE | _Inotify.IN_DELETE
+                  | _Inotify.IN_MOVED_FROM | _Inotify.IN_MOVED_TO
+                  | _Inotify.IN_ONLYDIR)
+
+    def __init__(self, path_to_attributes, directory, single_match=False):
+        self.path_to_attributes = path_to_attributes
+        self.directory = directory
+        self.single_match = single_match
+        self._inotify = _Inotify()
+        try:
+            self._clear()
+            self.rescan()
+        except Exception:
+            self._inotify.close()
+            raise
+
+    def _clear(self):
+        # entry id -> (path tuple, attributes)
+        self._entries = {}
+        # path tuple -> list of entry ids
+        self._path_entries = {}
+        # (attribute, value) -> set of entry ids
+        self._index = {}
+        # directory path tuple -> set of names of its indexed entries and
+        # watched directories (including intermediate directories)
+        self._children = {}
+        self._watches = {}
+        self._watched_paths = {}
+        self._next_id = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''
+        Stop following the filesystem changes.
+        '''
+        self._inotify.close()
+
+    def fileno(self):
+        '''
+        File descriptor readable when filesystem events are pending.
+        '''
+        return self._inotify.fd
+
+    def rescan(self):
+        '''
+        Parse the whole directory again.
+        '''
+        for wd in list(self._watches):
+            self._inotify.rm_watch(wd)
+        self._clear()
+        self._update(())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def process_events(self, timeout=0):
+        '''
+        Update the index according to the pending filesystem events,
+        waiting at most timeout seconds (None to wait forever) for the first
+        one. Return the number of processed events.
+        '''
+        events = self._inotify.read_events(timeout)
+        changed = set()
+        for wd, mask, cookie, name in events:
+            if mask & _Inotify.IN_Q_OVERFLOW:
+                # some events have been lost
+                self.rescan()
+                return len(events)
+            if mask & _Inotify.IN_IGNORED:
+                path = self._watches.pop(wd, None)
+                if path is not None \
+                        and self._watched_paths.get(path) == wd:
+                    del self._watched_paths[path]
+                continue
+            path = self._watches.get(wd)
+            if path is None or not name:
+                continue
+            changed.add(path + (name, ))
+        for path in sorted(changed):
+            self._update(path)
+        return len(events)
+
+    def _update(self, path):
+        '''
+        Parse again the entry of the given path (and its subtree) and
+        update the index.
+        '''
+        self._remove_subtree(path)
+        abs_path = osp.join(self.directory, *path)
+        cache = _ListedDirectoriesCache()
+        if path:
+            try:
+                st = os.stat(abs_path)
+            except OSError:
+                # the entry does not exist (anymore)
+                return
+            content = None
+            if osp.isdir(abs_path):
+                content = _RecordingDirectory._subdirectory(abs_path, cache)
+            dirdict = {path[-1]: [st, content]}
+            for name in reversed(path[:-1]):
+                dirdict = {name: [None, dirdict]}
+        else:
+            dirdict = _RecordingDirectory._subdirectory(abs_path, cache)
+        self._parse(dirdict, path)
+        if self._watch(cache.listed) and path:
+            # entries may have been created in the new directories before
+            # they were watched
+            self._remove_subtree(path, unwatch=False)
+            self._parse(dirdict, path)
+            self._watch(cache.listed)
+
+    def _parse(self, dirdict, path):
+        length = len(path)
+        for parsed_path, st, attributes in \
+                self.path_to_attributes.parse_directory(
+                    dirdict, single_match=self.single_match):
+            parsed_path = tuple(parsed_path)
+            if parsed_path[:length] == path:
+                self._add(parsed_path, attributes)
+
+    def _watch(self, directories):
+        '''
+        Watch the given directories, if they are not already watched.
+        Return True if new watches have been added.
+        '''
+        new_watches = False
+        for directory in directories:
+            if directory == self.directory:
+                path = ()
+            else:
+                path = tuple(osp.relpath(directory,
+                                         self.directory).split(os.sep))
+            if path not in self._watched_paths:
+                try:
+                    wd = self._inotify.add_watch(directory, self.watch_mask)
+                except OSError as e:
+                    if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                        # removed since it was listed
+                        continue
+                    raise
+                self._watches[wd] = path
+                self._watched_paths[path] = wd
+                new_watches = True
+            self._add_child(path)
+        return new_watches
+
+    def _add_child(self, path):
+        for i in range(len(path)):
+            self._children.setdefault(path[:i], set()).add(path[i])
+
+    def _add(self, path, attributes):
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = (path, attributes)
+        self._path_entries.setdefault(path, []).append(entry_id)
+        for item in six.iteritems(attributes):
+            try:
+                self._index.setdefault(item, set()).add(entry_id)
+            except TypeError:
+                # unhashable attribute value: not indexed
+                pass
+        self._add_child(path)
+
+    def _remove_subtree(self, path, unwatch=True):
+        if path:
+            siblings = self._children.get(path[:-1])
+            if siblings is not None:
+                siblings.discard(path[-1])
+        stack = [path]
+        while stack:
+            path = stack.pop()
+            for entry_id in self._path_entries.pop(path, ()):
+                entry_path, attributes = self._entries.pop(entry_id)
+                for item in six.iteritems(attributes):
+                    try:
+                        entry_ids = self._index.get(item)
+                    except TypeError:
+                        continue
+                    if entry_ids is not None:
+                        entry_ids.discard(entry_id)
+                        if not entry_ids:
+                            del self._index[item]
+            if unwatch and path:
+                wd = self._watched_paths.pop(path, None)
+                if wd is not None:
+                    del self._watches[wd]
+                    self._inotify.rm_watch(wd)
+            stack.extend(path + (name, )
+                         for name in self._children.pop(path, ()))
+
+    def find(self, **attributes):
+        '''
+        Iterate over the (path, attributes) of the indexed entries whose
+        attributes contain the given values.
+        '''
+        self.process_events()
+        entry_ids = None
+        for item in sorted(six.iteritems(attributes),
+                           key=lambda item: len(self._index.get(item, ()))):
+            ids = self._index.get(item)
+            if not ids:
+                return
+            if entry_ids is None:
+                entry_ids = set(ids)
+            else:
+                entry_ids &= ids
+        if entry_ids is None:
+            entry_ids = self._entries
+        for entry_id in sorted(entry_ids):
+            path, entry_attributes = self._entries[entry_id]
+            yield '/'.join(path), entry_attributes.copy()
+
+    def attributes(self, path):
+        '''
+        List of the attributes dicts of an indexed path (relative to the
+        indexed directory, using "/" as separator).
+        '''
+        self.process_events()
+        return [self._entries[entry_id][1].copy()
+                for entry_id in self._path_entries.get(
+                    tuple(path.split('/')), ())]
+
+
+class FomDatabase(object):
+
+    '''
+    Persistent sqlite database of FOM parsing results.
+
+    Each (path, st, attributes) result of
+    :meth:`~soma.fom.PathToAttributes.parse_directory` (or
+    :meth:`~soma.fom.PathToAttributes.parse_filesystem`) is stored as a row
+    of the files table with the path (using "/" as separator), the mode,
+    size and modification time of the file, and one indexed column for each
+    attribute (fom_name included). Columns are added when new attributes
+    are found. Unknown entries (with None attributes) are not stored.
+    '''
+
+    # number of results inserted per executemany() call
+    batch_size = 10000
+
+    def __init__(self, filename=':memory:'):
+        self.filename = filename
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS files ( path TEXT, '
+                             'st_mode INTEGER, st_size INTEGER, '
+                             'st_mtime REAL )')
+            self._db.execute('CREATE INDEX IF NOT EXISTS files_path_index '
+                             'ON files ( path )')
+        self.attributes = [row[1][1:] for row in self._db.execute(
+            'PRAGMA table_info( files )') if row[1].startswith('_')]
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def _column(attribute):
+        return '"_%s"' % attribute.replace('"', '""')
+
+    def _add_attributes(self, attributes):
+        for attribute in sorted(attributes):
+            if attribute not in self.attributes:
+                column = self._column(attribute)
+                self._db.execute('ALTER TABLE files ADD COLUMN %s' % column)
+                self._db.execute('CREATE INDEX "files%s_index" ON files '
+                                 '( %s )' % (column[1:-1], column))
+                self.attributes.append(attribute)
+
+    def update(self, parse_results, replace=None, with_stat=True):
+        '''
+        Store parsing results, given as (path, st, attributes) tuples where
+        path is a list of names, in a single transaction. The rows already
+        stored for the paths of the results are replaced.
+
+        If replace is a path ('' for the whole tree), the rows of this path
+        and of its subtree are removed first: use it to update the database
+        after parsing again a part of the tree. If with_stat is False, st is
+        not used and the stat columns are left empty.
+
+        Return the number of stored rows.
+        '''
+        results = ((path, st, attributes)
+                   for path, st, attributes in parse_results
+                   if attributes is not None)
+        count = 0
+        cleared = set()
+        with self._db:
+            if replace is not None:
+                self._remove(replace, True)
+            while True:
+                batch = list(itertools.islice(results, self.batch_size))
+                if not batch:
+                    break
+                self._add_attributes(set(itertools.chain.from_iterable(
+                    attributes for path, st, attributes in batch)))
+                rows = []
+                for path, st, attributes in batch:
+                    if with_stat and st is not None:
+                        row = ['/'.join(path), st[0], st[6], st[8]]
+                    else:
+                        row = ['/'.join(path), None, None, None]
+                    row.extend(attributes.get(attribute)
+                               for attribute in self.attributes)
+                    rows.append(row)
+                if replace is None:
+                    # a path may have several rows, possibly spread over
+                    # several batches: only remove its old rows once
+                    new_paths = set(row[0] for row in rows) - cleared
+                    self._db.executemany('DELETE FROM files WHERE path = ?',
+                                         ((path, ) for path in new_paths))
+                    cleared.update(new_paths)
+                columns = ['path', 'st_mode', 'st_size', 'st_mtime'] \
+                    + [self._column(i) for i in self.attributes]
+                self._db.executemany(
+                    'INSERT INTO files ( %s ) VALUES ( %s )'
+                    % (', '.join(columns), ', '.join('?' * len(columns))),
+                    rows)
+                count += len(rows)
+        return count
+
+    def _remove(self, path, subtree):
+        path = path.strip('/')
+        if not path:
+            if subtree:
+                self._db.execute('DELETE FROM files')
+            return
+        sql = 'DELETE FROM files WHERE path = ?'
+        values = [path]
+        if subtree:
+            # paths starting with path + '/' ('0' follows '/')
+            sql += ' OR ( path > ? AND path < ? )'
+            values += [path + '/', path + '0']
+        self._db.execute(sql, values)
+
+    def remove(self, path, subtree=True):
+        '''
+        Remove the rows of a path (using "/" as separator), and of its
+        subtree if subtree is True.
+        '''
+        with self._db:
+            self._remove(path, subtree)
+
+    def _select(self, columns, attributes):
+        conditions = []
+        values = []
+        for attribute, value in sorted(six.iteritems(attributes)):
+            if attribute not in self.attributes:
+                # no stored file has this attribute
+                return None
+            column = self._column(attribute)
+            if isinstance(value, (list, tuple, set)):
+                value = list(value)
+                conditions.append('%s IN ( %s )'
+                                  % (column, ', '.join('?' * len(value))))
+                values.extend(value)
+            else:
+                conditions.append('%s = ?' % column)
+                values.append(value)
+        sql = 'SELECT %s FROM files' % columns
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        return self._db.execute(sql, values)
+
+    def find(self, **attributes):
+        '''
+        Iterate over the (path, attributes) of the stored files whose
+        attributes have the given values. A value may be a list of allowed
+        values.
+        '''
+        names = list(self.attributes)
+        cursor = self._select(
+            ', '.join(['path'] + [self._column(i) for i in names]),
+            attributes)
+        if cursor is None:
+            return
+        for row in cursor:
+            yield row[0], dict((name, value)
+                               for name, value in zip(names, row[1:])
+                               if value is not None)
+
+    def find_stat(self, **attributes):
+        '''
+        Iterate over the (path, st_mode, st_size, st_mtime) of the stored
+        files whose attributes have the given values.
+        '''
+        cursor = self._select('path, st_mode, st_size, st_mtime', attributes)
+        if cursor is None:
+            return
+        for row in cursor:
+            yield row
+
+    def count(self, **attributes):
+        '''
+        Number of stored files whose attributes have the given values.
+        '''
+        cursor = self._select('COUNT(*)', attributes)
+        if cursor is None:
+            return 0
+        return cursor.fetchone()[0]
+
+    def attribute_values(self, attribute, **attributes):
+        '''
+        Sorted distinct values of an attribute among the stored files whose
+        attributes have the given values.
+        '''
+        if attribute not in self.attributes:
+            return []
+        cursor = self._select('DISTINCT %s' % self._column(attribute),
+                              attributes)
+        if cursor is None:
+            return []
+        return sorted(row[0] for row in cursor if row[0] is not None)
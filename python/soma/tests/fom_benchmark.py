@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks of the File Organization Models (:mod:`soma.fom`).
+
+A synthetic database (centers x subjects x acquisitions) is generated from a
+FOM using :class:`~soma.fom.AttributesToPaths`, either as real files in a
+temporary directory or as an in-memory dictionary (as built by
+:class:`~soma.fom.DirectoryAsDict`). The times of :meth:`load_foms`,
+:class:`~soma.fom.AttributesToPaths` construction, :meth:`find_paths` and
+:meth:`parse_directory` are measured at several scales and written as JSON::
+
+    python -m soma.tests.fom_benchmark --scale 2x10x2 --scale 10x200x2 \\
+        --files --output fom_benchmark.json
+
+With --dotted, subjects and acquisitions names contain many dots (as in
+``sub.01.ses.02.run.1.nii.gz``), to measure the cost of extensions
+recognition.
+'''
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import os.path as osp
+import sys
+import json
+import time
+import shutil
+import tempfile
+import itertools
+import argparse
+import platform
+
+import six
+
+from soma import fom
+
+
+benchmark_fom_definition = {
+    "fom_name": "benchmark_fom",
+
+    "formats": {
+        "NIFTI": "nii",
+        "NIFTI gz": "nii.gz",
+        "GIS": "ima",
+        "Graph": "arg",
+        "JSON": "json",
+        "Transformation matrix": "trm"
+    },
+
+    "format_lists": {
+        "images": ["NIFTI gz", "NIFTI", "GIS"]
+    },
+
+    "attribute_definitions": {
+        "acquisition": {"default_value": "default_acquisition"},
+        "analysis": {"default_value": "default_analysis"},
+        "side": {"values": ["L", "R"]}
+    },
+
+    "shared_patterns": {
+        "acquisition": "<center>/<subject>/t1mri/<acquisition>",
+        "analysis": "{acquisition}/<analysis>"
+    },
+
+    "processes": {
+        "Morphologist": {
+            "t1mri":
+                [["input:{acquisition}/<subject>", "images"]],
+            "nobias":
+                [["output:{analysis}/nobias_<subject>", "images"]],
+            "split":
+                [["output:{analysis}/segmentation/voronoi_<subject>",
+                  "images"]],
+            "left_graph":
+                [["output:{analysis}/folds/<side><subject>", "Graph",
+                  {"side": "L"}]],
+            "right_graph":
+                [["output:{analysis}/folds/<side><subject>", "Graph",
+                  {"side": "R"}]],
+            "left_mesh":
+                [["output:{analysis}/segmentation/mesh/<subject>_<side>white",
+                  "JSON", {"side": "L"}]],
+            "talairach":
+                [["output:{acquisition}/registration/"
+                  "RawT1-<subject>_<acquisition>_TO_Talairach",
+                  "Transformation matrix"]]
+        }
+    }
+}
+
+default_scales = [(2, 10, 2), (5, 50, 2), (10, 200, 2)]
+
+
+def selections(centers, subjects, acquisitions, dotted=False):
+    '''
+    Iterate over the attributes of the subjects acquisitions of a synthetic
+    database. If dotted is True, subjects and acquisitions names contain
+    many dots.
+    '''
+    if dotted:
+        subject_name = 'sub.%02d.%03d.ses.01'
+        acquisition_name = 'acq.%d.run.1'
+    else:
+        subject_name = 'subject%d_%d'
+        acquisition_name = 'acquisition%d'
+    for center, subject, acquisition in itertools.product(
+            range(centers), range(subjects), range(acquisitions)):
+        yield {'center': 'center%d' % center,
+               'subject': subject_name % (center, subject),
+               'acquisition': acquisition_name % acquisition}
+
+
+def generate_paths(atp, centers, subjects, acquisitions, dotted=False):
+    '''
+    Sorted list of all the paths generated by the AttributesToPaths atp for
+    a database of the given size.
+    '''
+    paths = set()
+    for attributes in selections(centers, subjects, acquisitions, dotted):
+        paths.update(path for path, path_attributes
+                     in atp.find_paths(attributes))
+    return sorted(paths)
+
+
+def create_files(paths, directory):
+    '''
+    Create empty files for the given relative paths in directory.
+    '''
+    for path in paths:
+        path = osp.join(directory, *path.split('/'))
+        parent = osp.dirname(path)
+        if not osp.isdir(parent):
+            os.makedirs(parent)
+        open(path, 'w').close()
+
+
+def _timed(repeat, function, *args, **kwargs):
+    '''
+    Call function repeat times, return the shortest time and the result of
+    the last call.
+    '''
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = function(*args, **kwargs)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best, result
+
+
+def _find_all_paths(atp, centers, subjects, acquisitions, dotted):
+    count = 0
+    for attributes in selections(centers, subjects, acquisitions, dotted):
+        for path in atp.find_paths(attributes):
+            count += 1
+    return count
+
+
+def _load_foms(fom_directory):
+    manager = fom.FileOrganizationModelManager([fom_directory])
+    return manager.load_foms(benchmark_fom_definition['fom_name'])
+
+
+def _parse(pta, dirdict):
+    if isinstance(dirdict, six.string_types):
+        dirdict = fom.DirectoryAsDict(dirdict)
+    return len(list(pta.parse_directory(dirdict)))
+
+
+def run_benchmark(scales=default_scales, files=False, repeat=3,
+                  work_directory=None, dotted=False, log=None):
+    '''
+    Run the benchmarks for each (centers, subjects, acquisitions) scale, and
+    return the results as a JSON compatible dictionary. If files is True,
+    the database is created as files in a temporary directory (in
+    work_directory if given), otherwise it is parsed from memory. If dotted
+    is True, names of subjects and acquisitions contain many dots. If log is
+    given, a line is written in this file after each scale.
+    '''
+    tmp = tempfile.mkdtemp(prefix='soma_fom_benchmark', dir=work_directory)
+    try:
+        fom_directory = osp.join(tmp, 'foms')
+        os.mkdir(fom_directory)
+        with open(osp.join(fom_directory, 'benchmark_fom.json'), 'w') as f:
+            json.dump(benchmark_fom_definition, f)
+        load_time, foms = _timed(repeat, _load_foms, fom_directory)
+        atp_time, atp = _timed(repeat, fom.AttributesToPaths, foms,
+                               find_paths_cache_size=0)
+        pta_time, pta = _timed(repeat, fom.PathToAttributes, foms)
+        results = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'files': files,
+            'dotted': dotted,
+            'repeat': repeat,
+            'load_foms': load_time,
+            'attributes_to_paths': atp_time,
+            'path_to_attributes': pta_time,
+            'scales': [],
+        }
+        for centers, subjects, acquisitions in scales:
+            paths = generate_paths(atp, centers, subjects, acquisitions,
+                                   dotted)
+            if files:
+                dirdict = osp.join(tmp, 'database_%dx%dx%d'
+                                   % (centers, subjects, acquisitions))
+                create_files(paths, dirdict)
+            else:
+                dirdict = fom.DirectoryAsDict.paths_to_dict(*paths)
+            find_time, found = _timed(repeat, _find_all_paths, atp, centers,
+                                      subjects, acquisitions, dotted)
+            parse_time, parsed = _timed(repeat, _parse, pta, dirdict)
+            queries = centers * subjects * acquisitions
+            result = {
+                'centers': centers,
+                'subjects': subjects,
+                'acquisitions': acquisitions,
+                'paths': len(paths),
+                'find_paths': find_time,
+                'find_paths_queries': queries,
+                'find_paths_results': found,
+                'parse_directory': parse_time,
+                'parse_directory_results': parsed,
+            }
+            results['scales'].append(result)
+            if log is not None:
+                print('%dx%dx%d: %d paths, find_paths %.3fs (%d queries), '
+                      'parse_directory %.3fs'
+                      % (centers, subjects, acquisitions, len(paths),
+                         find_time, queries, parse_time), file=log)
+        return results
+    finally:
+        shutil.rmtree(tmp)
+
+
+def _scale(value):
+    try:
+        scale = tuple(int(i) for i in value.split('x'))
+    except ValueError:
+        scale = ()
+    if len(scale) != 3:
+        raise argparse.ArgumentTypeError(
+            'scale must be CENTERSxSUBJECTSxACQUISITIONS, not %r' % value)
+    return scale
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument(
+        '--scale', type=_scale, action='append',
+        help='database size, as CENTERSxSUBJECTSxACQUISITIONS (may be used '
+        'several times, default: %s)'
+        % ' '.join('%dx%dx%d' % scale for scale in default_scales))
+    parser.add_argument(
+        '--files', action='store_true',
+        help='create the database as files instead of parsing it from '
+        'memory')
+    parser.add_argument(
+        '--dotted', action='store_true',
+        help='use subjects and acquisitions names containing many dots')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs of each measure (the shortest '
+                        'time is kept, default: 3)')
+    parser.add_argument('--tmp', help='directory of the temporary files')
+    parser.add_argument('-o', '--output',
+                        help='JSON output file (default: standard output)')
+    options = parser.parse_args(argv)
+    results = run_benchmark(options.scale or default_scales,
+                            files=options.files, repeat=options.repeat,
+                            work_directory=options.tmp,
+                            dotted=options.dotted, log=sys.stderr)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -7,11 +7,54 @@ import unittest
 import shutil
 import os
 import tempfile
+import time
+import stat
+import json
+import copy
+import threading
 from soma import application
 from soma import fom
 import sys
 
 
+test_fom_definition = {
+    "fom_name": "test_parse_fom",
+
+    "formats": {
+        "NIFTI": "nii",
+        "NIFTI gz": "nii.gz",
+        "GIS": "ima",
+        "Graph": "arg"
+    },
+
+    "format_lists": {
+        "images": ["NIFTI gz", "NIFTI", "GIS"]
+    },
+
+    "attribute_definitions": {
+        "acquisition" : {"default_value" : "default_acquisition"},
+        "side": {"values": ["L", "R"]}
+    },
+
+    "shared_patterns": {
+      "acquisition": "<center>/<subject>/t1mri/<acquisition>"
+    },
+
+    "processes": {
+        "Morphologist": {
+            "t1mri":
+                [["input:{acquisition}/<subject>", "images"]],
+            "left_graph":
+                [["output:{acquisition}/folds/<side><subject>", "Graph",
+                  {"side": "L"}]],
+            "referential":
+                [["output:{acquisition}/RawT1-<subject>_<acquisition>",
+                  "images"]]
+        }
+    }
+}
+
+
 class TestFOM(unittest.TestCase):
 
     def setUp(self):
@@ -72,6 +115,865 @@ class TestFOM(unittest.TestCase):
         atp = fom.AttributesToPaths(foms)
         pta = fom.PathToAttributes(foms)
 
+    def test_find_paths_cache(self):
+        foms = fom.FileOrganizationModels()
+        foms.import_file(test_fom_definition)
+        directories = {'input': '/input', 'output': '/output'}
+        atp = fom.AttributesToPaths(foms, directories=directories,
+                                    find_paths_cache_size=2)
+        ref_atp = fom.AttributesToPaths(foms, directories=directories,
+                                        find_paths_cache_size=0)
+        attributes = {'center': 'c1', 'subject': 's1',
+                      'fom_parameter': 't1mri'}
+        expected = sorted(ref_atp.find_paths(attributes))
+        self.assertEqual(len(expected), 3)
+        self.assertEqual(sorted(atp.find_paths(attributes)), expected)
+        result = sorted(atp.find_paths(dict(attributes)))
+        self.assertEqual(result, expected)
+        # returned attributes are copies
+        result[0][1]['subject'] = 'modified'
+        self.assertEqual(sorted(atp.find_paths(attributes)), expected)
+        self.assertEqual(atp.find_paths_cache_info()['hits'], 2)
+        self.assertEqual(atp.find_paths_cache_info()['misses'], 1)
+        atp.directories['input'] = '/other_input'
+        result = sorted(atp.find_paths(attributes))
+        self.assertEqual(result[0][0],
+                         os.path.join('/other_input', 'c1', 's1', 't1mri',
+                                      'default_acquisition', 's1.ima'))
+        self.assertEqual(atp.find_paths_cache_info()['size'], 1)
+        attributes = {'center': 'c1', 'subject': 's1',
+                      'fom_parameter': ['t1mri', 'referential']}
+        expected = sorted(ref_atp.find_paths(attributes))
+        self.assertEqual(len(expected), 6)
+        self.assertEqual(sorted(atp.find_paths(attributes)), expected)
+        self.assertEqual(ref_atp.find_paths_cache_info()['size'], 0)
+        # equal values of different types are different keys
+        for center in (1, True, 1.0):
+            attributes = {'center': center, 'subject': 's1',
+                          'fom_parameter': 't1mri'}
+            self.assertEqual(sorted(atp.find_paths(attributes)),
+                             sorted(ref_atp.find_paths(attributes)))
+
+    def test_find_existing_paths(self):
+        foms = fom.FileOrganizationModels()
+        foms.import_file(test_fom_definition)
+        directories = {'input': os.path.join(self.work_dir, 'input'),
+                       'output': os.path.join(self.work_dir, 'output')}
+        atp = fom.AttributesToPaths(foms, directories=directories,
+                                    listing_cache_ttl=60)
+        attributes = {'center': 'c1', 'subject': 's1'}
+        paths = sorted(path for path, path_attributes
+                       in atp.find_paths(attributes))
+        existing = [paths[0], paths[-1]]
+        for path in existing:
+            os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        self.assertEqual(sorted(path for path, path_attributes
+                                in atp.find_existing_paths(attributes)),
+                         existing)
+        self.assertEqual(
+            sorted((path, exists) for path, path_attributes, exists
+                   in atp.find_existing_paths(attributes, annotate=True)),
+            [(path, path in existing) for path in paths])
+        # listings are cached
+        os.remove(paths[0])
+        self.assertEqual(sorted(path for path, path_attributes
+                                in atp.find_existing_paths(attributes)),
+                         existing)
+        atp.clear_listing_cache()
+        self.assertEqual([path for path, path_attributes
+                          in atp.find_existing_paths(attributes)],
+                         existing[1:])
+        # the number of kept listings is bounded
+        atp = fom.AttributesToPaths(foms, directories=directories,
+                                    listing_cache_ttl=60,
+                                    listing_cache_size=1)
+        self.assertEqual(sorted(path for path, path_attributes
+                                in atp.find_existing_paths(attributes)),
+                         existing[1:])
+        self.assertEqual(len(atp._listing_cache), 1)
+
+    def test_find_paths_many(self):
+        foms = fom.FileOrganizationModels()
+        foms.import_file(test_fom_definition)
+        atp = fom.AttributesToPaths(foms, find_paths_cache_size=0)
+        attributes_list = []
+        for subject in ('s1', 's2'):
+            for parameter in (None, 't1mri', ['t1mri', 'referential']):
+                for format in (None, 'NIFTI', 'fom_first'):
+                    attributes = {'center': 'c1', 'subject': subject}
+                    if parameter is not None:
+                        attributes['fom_parameter'] = parameter
+                    if format is not None:
+                        attributes['fom_format'] = format
+                    attributes_list.append(attributes)
+        expected = [sorted(atp.find_paths(attributes))
+                    for attributes in attributes_list]
+        result = atp.find_paths_many(attributes_list)
+        self.assertEqual([sorted(r) for r in result], expected)
+        cached_atp = fom.AttributesToPaths(foms)
+        cached_atp.find_paths(attributes_list[0])
+        result = cached_atp.find_paths_many(attributes_list)
+        self.assertEqual([sorted(r) for r in result], expected)
+        self.assertEqual(cached_atp.find_paths_cache_info()['hits'], 1)
+        self.assertEqual(atp.find_paths_many([]), [])
+        # default values which are not strings
+        int_foms = fom.FileOrganizationModels()
+        int_foms.import_file({
+            'fom_name': 'int_default',
+            'formats': {'NIFTI': 'nii'},
+            'attribute_definitions': {'acquisition': {'default_value': 3}},
+            'processes': {'P': {
+                'a': [['input:<center>/<acquisition>/<subject>', 'NIFTI']],
+                'b': [['input:<center>/v<acquisition>/<subject>', 'NIFTI',
+                       {'acquisition': '3'}]]}}})
+        int_atp = fom.AttributesToPaths(int_foms, directories={'input': ''},
+                                        find_paths_cache_size=0)
+        int_attributes = {'center': 'c', 'subject': 's'}
+        int_expected = sorted(int_atp.find_paths(int_attributes))
+        self.assertEqual([path for path, path_attributes in int_expected],
+                         ['c/3/s.nii', 'c/v3/s.nii'])
+        self.assertEqual(
+            sorted(int_atp.find_paths_many([int_attributes])[0]),
+            int_expected)
+        # concurrent calls from several threads
+        results = []
+
+        def find_paths_many():
+            for i in range(20):
+                results.append([sorted(r) for r
+                                in atp.find_paths_many(attributes_list)])
+
+        threads = [threading.Thread(target=find_paths_many)
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 80)
+        for result in results:
+            self.assertEqual(result, expected)
+
+    def test_bitset_engine(self):
+        foms = fom.FileOrganizationModels()
+        foms.import_file(test_fom_definition)
+        sqlite_atp = fom.AttributesToPaths(foms, find_paths_cache_size=0)
+        bitset_atp = fom.AttributesToPaths(foms, find_paths_cache_size=0,
+                                           engine='bitset')
+        for attributes in ({}, {'subject': 's1'},
+                           {'subject': 's1', 'acquisition': 'a1',
+                            'fom_format': 'fom_first'},
+                           {'center': 'c1', 'subject': 's1',
+                            'fom_parameter': ['t1mri', 'left_graph'],
+                            'fom_format': ['NIFTI', 'Graph']},
+                           {'subject': 's1', 'side': 'R'}):
+            self.assertEqual(sorted(bitset_atp.find_paths(attributes)),
+                             sorted(sqlite_atp.find_paths(attributes)))
+        self.assertEqual(
+            [sorted(r) for r in bitset_atp.find_paths_many(
+                [{'subject': 's1'}, {'subject': 's2'}])],
+            [sorted(sqlite_atp.find_paths(attributes))
+             for attributes in ({'subject': 's1'}, {'subject': 's2'})])
+        for selection in ({}, {'fom_parameter': 'left_graph'}):
+            self.assertEqual(
+                bitset_atp.find_attributes_values(**selection),
+                sqlite_atp.find_attributes_values(**selection))
+            self.assertEqual(
+                bitset_atp.find_discriminant_attributes(**selection),
+                sqlite_atp.find_discriminant_attributes(**selection))
+        self.assertRaises(ValueError, fom.AttributesToPaths, foms,
+                          engine='unknown')
+
+    def test_attributes_values(self):
+        foms = fom.FileOrganizationModels()
+        foms.import_file(test_fom_definition)
+        atp = fom.AttributesToPaths(foms)
+        values = atp.find_attributes_values()
+        self.assertEqual(values['side'], [(None,), ('L',)])
+        self.assertEqual(values['fom_parameter'],
+                         [('left_graph',), ('referential',), ('t1mri',)])
+        self.assertEqual(values['acquisition'], [('',)])
+        values['side'].append(('R',))
+        self.assertEqual(atp.find_attributes_values()['side'],
+                         [(None,), ('L',)])
+        self.assertEqual(atp._attributes_values_cache.info()['hits'], 1)
+        values = atp.find_attributes_values(fom_parameter='left_graph')
+        self.assertEqual(values['side'], [('L',)])
+        self.assertEqual(values['fom_format'], [('Graph',)])
+        self.assertEqual(
+            sorted(atp.find_discriminant_attributes()),
+            ['acquisition', 'center', 'fom_format', 'fom_parameter', 'side',
+             'subject'])
+        self.assertEqual(atp.find_attributes_values(side=None)['side'], [])
+        # concurrent use with find_paths_many, on a new instance whose
+        # values bitsets are not built yet
+        expected = atp.find_attributes_values(fom_parameter='t1mri')
+        atp = fom.AttributesToPaths(foms, find_paths_cache_size=0)
+        results = []
+
+        def attributes_values():
+            results.append(atp.find_attributes_values(fom_parameter='t1mri'))
+
+        def find_paths_many():
+            for i in range(10):
+                atp.find_paths_many([{'center': 'c1', 'subject': 's1'}])
+
+        threads = [threading.Thread(target=function)
+                   for function in (attributes_values, find_paths_many) * 3]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [expected] * 3)
+
+    def test_rules_table(self):
+        import logging
+
+        foms = fom.FileOrganizationModels()
+        foms.import_file(test_fom_definition)
+        logger = logging.getLogger('soma.tests.test_fom')
+        with self.assertLogs(logger, logging.DEBUG) as logs:
+            atp = fom.AttributesToPaths(foms, debug=logger)
+        self.assertTrue(atp.construction_time >= 0)
+        self.assertTrue(any('rules index of 7 rows built' in message
+                            for message in logs.output))
+        self.assertEqual(
+            atp._db.execute('SELECT COUNT(*) FROM rules').fetchone()[0], 7)
+        indexes = [row[0] for row in atp._db.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")]
+        self.assertEqual(len(indexes), len(atp.all_attributes) + 3)
+
+    def test_rules_cache(self):
+        foms = fom.FileOrganizationModels()
+        foms.import_file(test_fom_definition)
+        cache_directory = os.path.join(self.work_dir, 'cache')
+        ref_atp = fom.AttributesToPaths(foms)
+        atp = fom.AttributesToPaths(foms,
+                                    cache_directory=cache_directory)
+        cache_files = os.listdir(cache_directory)
+        self.assertEqual(len(cache_files), 1)
+        cached_atp = fom.AttributesToPaths(
+            foms, cache_directory=cache_directory)
+        self.assertEqual(os.listdir(cache_directory), cache_files)
+        self.assertEqual(cached_atp.rules, atp.rules)
+        attributes_list = [
+            {'center': 'c1', 'subject': 's1'},
+            {'center': 'c1', 'subject': 's1', 'fom_format': 'fom_first'},
+            {'center': 'c1', 'subject': 's1',
+             'fom_parameter': ['t1mri', 'left_graph']}]
+        for attributes in attributes_list:
+            self.assertEqual(sorted(cached_atp.find_paths(attributes)),
+                             sorted(ref_atp.find_paths(attributes)))
+        self.assertEqual(
+            [sorted(r) for r in
+             cached_atp.find_paths_many(attributes_list)],
+            [sorted(ref_atp.find_paths(attributes))
+             for attributes in attributes_list])
+        fom.AttributesToPaths(foms, selection={'fom_parameter': 't1mri'},
+                              cache_directory=cache_directory)
+        self.assertEqual(len(os.listdir(cache_directory)), 2)
+        # rules which cannot be saved are not cached
+        definition = json.loads(json.dumps(test_fom_definition))
+        definition['processes']['Morphologist']['left_graph'][0][2][
+            'extra'] = b'x'
+        bytes_foms = fom.FileOrganizationModels()
+        bytes_foms.import_file(definition)
+        fom.AttributesToPaths(bytes_foms, cache_directory=cache_directory)
+        self.assertEqual(len(os.listdir(cache_directory)), 2)
+
+    def test_fom_registry(self):
+        fom_path = os.path.join(self.work_dir, 'registry_foms')
+        cache_directory = os.path.join(self.work_dir, 'registry_cache')
+        os.makedirs(os.path.join(fom_path, 'dir_fom'))
+        with open(os.path.join(fom_path, 'file_fom.json'), 'w') as f:
+            json.dump({'fom_name': 'file_fom'}, f)
+        with open(os.path.join(fom_path, 'dir_fom', 'dir_fom.json'),
+                  'w') as f:
+            json.dump({'fom_name': 'dir_fom'}, f)
+        open(os.path.join(fom_path, 'empty.json'), 'w').close()
+        manager = fom.FileOrganizationModelManager(
+            [fom_path], cache_directory=cache_directory)
+        self.assertEqual(sorted(manager.find_foms()),
+                         ['dir_fom', 'file_fom'])
+        registry_file = os.path.join(cache_directory, 'fom_registry.json')
+        with open(registry_file) as f:
+            registry = json.load(f)
+        self.assertEqual(len(registry['files']), 3)
+        # an unchanged file is not read again
+        os.chmod(os.path.join(fom_path, 'file_fom.json'), 0)
+        try:
+            if not os.access(os.path.join(fom_path, 'file_fom.json'),
+                             os.R_OK):
+                manager = fom.FileOrganizationModelManager(
+                    [fom_path], cache_directory=cache_directory)
+                self.assertEqual(sorted(manager.find_foms()),
+                                 ['dir_fom', 'file_fom'])
+        finally:
+            os.chmod(os.path.join(fom_path, 'file_fom.json'),
+                     stat.S_IRUSR | stat.S_IWUSR)
+        with open(os.path.join(fom_path, 'file_fom.json'), 'w') as f:
+            json.dump({'fom_name': 'renamed_fom'}, f)
+        self.assertEqual(sorted(manager.find_foms()),
+                         ['dir_fom', 'renamed_fom'])
+        self.assertEqual(manager.file_name('renamed_fom'),
+                         os.path.join(fom_path, 'file_fom.json'))
+
+    def test_fom_bundle(self):
+        fom_path = os.path.join(self.work_dir, 'bundle_foms')
+        cache_directory = os.path.join(self.work_dir, 'bundle_cache')
+        os.makedirs(fom_path)
+        base_definition = dict(test_fom_definition, fom_name='base_fom')
+        with open(os.path.join(fom_path, 'base_fom.json'), 'w') as f:
+            json.dump(base_definition, f)
+        with open(os.path.join(fom_path, 'main_fom.json'), 'w') as f:
+            json.dump({'fom_name': 'main_fom', 'fom_import': ['base_fom'],
+                       'formats': {'MINC': 'mnc'}}, f)
+        manager = fom.FileOrganizationModelManager(
+            [fom_path], cache_directory=cache_directory)
+        foms = manager.load_foms('main_fom')
+        self.assertEqual(foms.fom_names, ['base_fom', 'main_fom'])
+        bundles = [i for i in os.listdir(cache_directory)
+                   if i.startswith('fom_bundle_')]
+        self.assertEqual(len(bundles), 1)
+        manager = fom.FileOrganizationModelManager(
+            [fom_path], cache_directory=cache_directory)
+        bundle_foms = manager.load_foms('main_fom')
+        self.assertEqual(bundle_foms.rules, foms.rules)
+        self.assertEqual(bundle_foms.formats, foms.formats)
+        self.assertEqual(bundle_foms.attribute_definitions,
+                         foms.attribute_definitions)
+        # modifying an imported FOM invalidates the bundle
+        base_definition['formats'] = dict(base_definition['formats'],
+                                          JSON='json')
+        with open(os.path.join(fom_path, 'base_fom.json'), 'w') as f:
+            json.dump(base_definition, f)
+        foms = manager.load_foms('main_fom')
+        self.assertEqual(foms.formats['JSON'], 'json')
+        # relocated FOM files replace the previous bundle
+        moved_path = os.path.join(self.work_dir, 'moved_foms')
+        os.rename(fom_path, moved_path)
+        manager = fom.FileOrganizationModelManager(
+            [moved_path], cache_directory=cache_directory)
+        manager.load_foms('main_fom')
+        bundles = [i for i in os.listdir(cache_directory)
+                   if i.startswith('fom_bundle_')]
+        self.assertEqual(len(bundles), 1)
+        # bundles writable by other users are not trusted
+        bundle_file = os.path.join(cache_directory, bundles[0])
+        self.assertTrue(manager._read_bundle(bundle_file) is not None)
+        if hasattr(os, 'getuid'):
+            os.chmod(bundle_file, 0o666)
+            self.assertEqual(manager._read_bundle(bundle_file), None)
+
+    def test_lazy_foms(self):
+        definition = copy.deepcopy(test_fom_definition)
+        definition['processes']['Other'] = {
+            'image': [['input:{acquisition}/other_<subject>', 'images']]}
+        foms = fom.FileOrganizationModels()
+        foms.import_file(copy.deepcopy(definition))
+        lazy_foms = fom.FileOrganizationModels(lazy=True)
+        lazy_foms.import_file(copy.deepcopy(definition))
+        self.assertEqual(lazy_foms.rules, [])
+        atp = fom.AttributesToPaths(foms, selection={'fom_process': 'Other'})
+        lazy_atp = fom.AttributesToPaths(
+            lazy_foms, selection={'fom_process': 'Other'})
+        self.assertEqual(len(lazy_foms.rules), 1)
+        attributes = {'center': 'c1', 'subject': 's1'}
+        self.assertEqual(sorted(lazy_atp.find_paths(attributes)),
+                         sorted(atp.find_paths(attributes)))
+        pta = fom.PathToAttributes(lazy_foms)
+        self.assertEqual(lazy_foms.rules, foms.rules)
+        self.assertEqual(pta.hierarchical_patterns,
+                         fom.PathToAttributes(foms).hierarchical_patterns)
+
+    def test_path_to_attributes(self):
+        foms = fom.FileOrganizationModels()
+        foms.import_file(test_fom_definition)
+        pta = fom.PathToAttributes(foms)
+        dirdict = fom.DirectoryAsDict.paths_to_dict(
+            'c1/s.1/t1mri/a1/s.1.nii.gz',
+            'c1/s.1/t1mri/a1/s.1.ima',
+            'c1/s.1/t1mri/a1/s.2.nii',
+            'c1/s.1/t1mri/a1/RawT1-s.1_a1.nii',
+            'c1/s.1/t1mri/a1/folds/Ls.1.arg',
+            'c1/s.1/t1mri/a1/folds/Rs.1.arg',
+            'c1/s.1/other/s.1.nii')
+        result = dict(('/'.join(path), attributes)
+                      for path, st, attributes
+                      in pta.parse_directory(dirdict, all_unknown=True))
+        self.assertEqual(result['c1/s.1/t1mri/a1/s.1.nii.gz']['fom_format'],
+                         'NIFTI gz')
+        self.assertEqual(result['c1/s.1/t1mri/a1/s.1.nii.gz']['subject'],
+                         's.1')
+        self.assertEqual(result['c1/s.1/t1mri/a1/s.1.ima']['fom_format'],
+                         'GIS')
+        # the subject in the file name has to be the subject directory
+        self.assertEqual(result['c1/s.1/t1mri/a1/s.2.nii'], None)
+        attributes = result['c1/s.1/t1mri/a1/RawT1-s.1_a1.nii']
+        self.assertEqual(attributes['fom_parameter'], 'referential')
+        self.assertEqual(attributes['acquisition'], 'a1')
+        attributes = result['c1/s.1/t1mri/a1/folds/Ls.1.arg']
+        self.assertEqual(attributes['side'], 'L')
+        self.assertEqual(attributes['center'], 'c1')
+        self.assertEqual(result['c1/s.1/t1mri/a1/folds/Rs.1.arg'], None)
+        self.assertEqual(result['c1/s.1/other/s.1.nii'], None)
+        matched = [path for path, st, attributes
+                   in pta.parse_directory(dirdict, single_match=True)]
+        self.assertEqual(len(matched), 4)
+        info = pta.regex_cache_info()
+        self.assertTrue(info['hits'] > 0)
+        self.assertTrue(info['misses'] > 0)
+        pta = fom.PathToAttributes(foms, regex_cache_size=1)
+        self.assertEqual(
+            len(list(pta.parse_directory(dirdict, single_match=True))), 4)
+        self.assertEqual(pta.regex_cache_info()['size'], 1)
+
+    def test_parse_directory_compact(self):
+        foms = fom.FileOrganizationModels()
+        foms.import_file(test_fom_definition)
+        pta = fom.PathToAttributes(foms)
+        dirdict = fom.DirectoryAsDict.paths_to_dict(
+            'c1/s1/t1mri/a1/s1.nii.gz',
+            'c1/s1/t1mri/a1/s1.ima',
+            'c1/s1/t1mri/a1/folds/Ls1.arg',
+            'c1/s2/t1mri/a1/RawT1-s2_a1.nii',
+            'c1/s2/unknown/file.txt')
+        for single_match in (False, True):
+            for all_unknown in (False, True):
+                expected = list(pta.parse_directory(
+                    dirdict, single_match=single_match,
+                    all_unknown=all_unknown))
+                results = pta.parse_directory_compact(
+                    dirdict, single_match=single_match,
+                    all_unknown=all_unknown)
+                self.assertEqual(len(results), len(expected))
+                self.assertEqual(list(results), expected)
+        self.assertEqual(results.path(0),
+                         ['c1', 's1', 't1mri', 'a1', 's1.nii.gz'])
+        index = results.names.index('Ls1.arg')
+        self.assertEqual(results.path(index),
+                         ['c1', 's1', 't1mri', 'a1', 'folds', 'Ls1.arg'])
+        self.assertEqual(results.attributes(index)['side'], 'L')
+        self.assertEqual(
+            results.directory_path(results.parent_ids[index]),
+            ['c1', 's1', 't1mri', 'a1', 'folds'])
+        # rules dicts are shared by results
+        self.assertTrue(len(results.rules) < len(results))
+        self.assertEqual(results.rule_ids[results.names.index('file.txt')],
+                         -1)
+        columns = results.numpy_columns()
+        self.assertEqual(list(columns['rule_ids']), list(results.rule_ids))
+
+    def test_multi_path_to_attributes(self):
+        foms = fom.FileOrganizationModels()
+        foms.import_file(test_fom_definition)
+        other_definition = copy.deepcopy(test_fom_definition)
+        other_definition['fom_name'] = 'test_other_fom'
+        other_definition['formats']['MINC'] = 'mnc'
+        other_definition['format_lists']['images'].append('MINC')
+        other_definition['processes']['Morphologist']['anat'] = \
+            [["input:<center>/<subject>/anat/<subject>", "images"]]
+        other_foms = fom.FileOrganizationModels()
+        other_foms.import_file(other_definition)
+        dirdict = fom.DirectoryAsDict.paths_to_dict(
+            'c1/s1/t1mri/a1/s1.nii',
+            'c1/s1/t1mri/a1/s1.mnc',
+            'c1/s1/t1mri/a1/folds/Ls1.arg',
+            'c1/s1/anat/s1.nii',
+            'c1/s1/anat/s1.mnc',
+            'c1/s1/other.txt')
+        expected = sorted(
+            list(fom.PathToAttributes(foms).parse_directory(dirdict))
+            + list(fom.PathToAttributes(other_foms).parse_directory(dirdict)),
+            key=repr)
+        pta = fom.MultiPathToAttributes([foms, other_foms])
+        result = list(pta.parse_directory(dirdict))
+        self.assertEqual(sorted(result, key=repr), expected)
+        fom_names = dict(('/'.join(path), sorted(
+            attributes['fom_name'] for p, s, attributes in result if p == path))
+            for path, st, attributes in result)
+        self.assertEqual(fom_names, {
+            'c1/s1/t1mri/a1/s1.nii': ['test_other_fom', 'test_parse_fom'],
+            'c1/s1/t1mri/a1/s1.mnc': ['test_other_fom'],
+            'c1/s1/t1mri/a1/folds/Ls1.arg': ['test_other_fom',
+                                             'test_parse_fom'],
+            'c1/s1/anat/s1.nii': ['test_other_fom'],
+            'c1/s1/anat/s1.mnc': ['test_other_fom']})
+        # identical patterns are merged: single_match keeps the rules of all
+        # the FOMs for the first matching pattern
+        result = list(pta.parse_directory(dirdict, single_match=True))
+        self.assertEqual(
+            [attributes['fom_name'] for path, st, attributes in result
+             if path == ['c1', 's1', 't1mri', 'a1', 's1.nii']],
+            ['test_parse_fom', 'test_other_fom'])
+
+    def test_directory_as_dict(self):
+        foms = fom.FileOrganizationModels()
+        foms.import_file(test_fom_definition)
+        pta = fom.PathToAttributes(foms)
+        root = os.path.join(self.work_dir, 'data')
+        for path in ('c1/s1/t1mri/a1/s1.nii.gz', 'c1/s1/t1mri/a1/s1.ima',
+                     'c1/s1/t1mri/a1/folds/Ls1.arg', 'c1/s1/other.txt'):
+            path = os.path.join(root, *path.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        expected = sorted(
+            ('/'.join(path), attributes) for path, st, attributes
+            in pta.parse_directory(fom.DirectoryAsDict.get_directory(root),
+                                   all_unknown=True))
+        self.assertEqual(len(expected), 9)
+        result = list(pta.parse_directory(fom.DirectoryAsDict(root),
+                                          all_unknown=True))
+        self.assertEqual(
+            sorted(('/'.join(path), attributes)
+                   for path, st, attributes in result), expected)
+        for path, st, attributes in result:
+            self.assertEqual(tuple(st),
+                             tuple(os.stat(os.path.join(root, *path))))
+        dirdict = fom.DirectoryAsDict.get_directory(root, with_stat=False)
+        self.assertEqual(dirdict['c1'][0], None)
+        self.assertEqual(
+            sorted(('/'.join(path), attributes) for path, st, attributes
+                   in pta.parse_directory(dirdict, all_unknown=True)),
+            expected)
+
+    def test_parse_filesystem(self):
+        foms = fom.FileOrganizationModels()
+        foms.import_file(test_fom_definition)
+        pta = fom.PathToAttributes(foms)
+        root = os.path.join(self.work_dir, 'data')
+        for path in ('c1/s1/t1mri/a1/s1.nii.gz', 'c1/s1/t1mri/a1/s1.ima',
+                     'c1/s1/t1mri/a1/folds/Ls1.arg', 'c1/s1/other.txt',
+                     'c1/s1/dicom/series/image.dcm'):
+            path = os.path.join(root, *path.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        listed = []
+        scandir = os.scandir
+
+        def recording_scandir(path):
+            listed.append(os.path.relpath(path, root))
+            return scandir(path)
+
+        os.scandir = recording_scandir
+        try:
+            for all_unknown in (False, True):
+                del listed[:]
+                expected = list(pta.parse_directory(
+                    fom.DirectoryAsDict.get_directory(root),
+                    all_unknown=all_unknown))
+                del listed[:]
+                result = list(pta.parse_filesystem(root,
+                                                   all_unknown=all_unknown))
+                self.assertEqual(
+                    [(path, attributes) for path, st, attributes in result],
+                    [(path, attributes)
+                     for path, st, attributes in expected])
+                self.assertEqual(
+                    os.path.join('c1', 's1', 'dicom') in listed,
+                    all_unknown)
+        finally:
+            os.scandir = scandir
+        self.assertEqual(len(result), 12)
+        self.assertRaises(ValueError, pta.parse_filesystem,
+                          os.path.join(root, 'c1', 's1', 'other.txt'))
+
+    def test_directories_cache_refresh(self):
+        root = os.path.join(self.work_dir, 'data')
+        for path in ('a/a1/f1', 'a/a2/f2', 'b/b1/f3', 'c/f4'):
+            path = os.path.join(root, *path.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        # make all directories look older than the scan
+        old_time = time.time() - 100
+        for dirpath, dirnames, filenames in os.walk(root):
+            os.utime(dirpath, (old_time, old_time))
+        cache = fom.DirectoriesCache()
+        cache.add_directory(root)
+        counts = cache.refresh()
+        self.assertEqual(counts, {'directories': 7, 'listed': 0})
+        open(os.path.join(root, 'a', 'a2', 'f5'), 'w').close()
+        os.mkdir(os.path.join(root, 'b', 'b2'))
+        open(os.path.join(root, 'b', 'b2', 'f6'), 'w').close()
+        os.unlink(os.path.join(root, 'c', 'f4'))
+        counts = cache.refresh()
+        self.assertEqual(counts['listed'], 4)
+
+        def names(content):
+            return dict((name, names(sub) if sub is not None else None)
+                        for name, (st, sub) in content.items())
+
+        self.assertEqual(names(cache.get_directory(root)[1]),
+                         names(fom.DirectoryAsDict.get_directory(root)))
+        # a subdirectory removed without a visible change of its parent is
+        # dropped without listing the parent again
+        for dirpath, dirnames, filenames in os.walk(root):
+            os.utime(dirpath, (old_time, old_time))
+        cache.refresh()
+        shutil.rmtree(os.path.join(root, 'a', 'a1'))
+        os.utime(os.path.join(root, 'a'), (old_time, old_time))
+        counts = cache.refresh()
+        self.assertEqual(counts, {'directories': 7, 'listed': 0})
+        self.assertEqual(names(cache.get_directory(root)[1]),
+                         names(fom.DirectoryAsDict.get_directory(root)))
+        # a removed cached directory is removed from the cache
+        shutil.rmtree(root)
+        self.assertEqual(cache.refresh(), {'directories': 0, 'listed': 0})
+        self.assertFalse(cache.has_directory(root))
+
+    def test_directories_cache_binary(self):
+        foms = fom.FileOrganizationModels()
+        foms.import_file(test_fom_definition)
+        pta = fom.PathToAttributes(foms)
+        root = os.path.join(self.work_dir, 'data')
+        for path in ('c1/s1/t1mri/a1/s1.nii.gz', 'c1/s1/t1mri/a1/s1.ima',
+                     'c1/s1/t1mri/a1/folds/Ls1.arg', 'c1/s1/other.txt'):
+            path = os.path.join(root, *path.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        cache = fom.DirectoriesCache()
+        cache.add_directory(root)
+        cache_file = os.path.join(self.work_dir, 'cache.bin')
+        cache.save(cache_file, format='binary')
+        self.assertTrue(fom.DirectoryTree.is_tree_file(cache_file))
+        loaded = fom.DirectoriesCache.load(cache_file)
+        st, content = loaded.get_directory(root)
+        self.assertTrue(isinstance(content, fom.DirectoryTreeNode))
+        self.assertEqual(st[stat.ST_MTIME],
+                         cache.get_directory(root)[0][stat.ST_MTIME])
+        self.assertEqual(sorted(content.keys()), ['c1'])
+        expected = list(pta.parse_directory(cache.get_directory(root)[1],
+                                            all_unknown=True))
+        for dirdict in (content, fom.DirectoryAsDict(cache_file),
+                        fom.DirectoryAsDict(root, loaded)):
+            result = list(pta.parse_directory(dirdict, all_unknown=True))
+            self.assertEqual(
+                sorted(('/'.join(path), st[stat.ST_SIZE], attributes)
+                       for path, st, attributes in result),
+                sorted(('/'.join(path), st[stat.ST_SIZE], attributes)
+                       for path, st, attributes in expected))
+        # JSON round trip of a binary cache
+        json_file = os.path.join(self.work_dir, 'cache.json')
+        loaded.save(json_file)
+        self.assertEqual(
+            fom.DirectoriesCache.load(json_file).get_directory(root)[1],
+            json.loads(json.dumps(content.to_dict())))
+
+    def test_directories_cache_diff(self):
+        foms = fom.FileOrganizationModels()
+        foms.import_file(test_fom_definition)
+        pta = fom.PathToAttributes(foms)
+        root = os.path.join(self.work_dir, 'data')
+        for path in ('c1/s1/t1mri/a1/s1.nii', 'c1/s1/t1mri/a1/s1.ima',
+                     'c1/s2/t1mri/a1/s2.nii', 'c2/s3/t1mri/a1/s3.nii'):
+            path = os.path.join(root, *path.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        old = fom.DirectoriesCache()
+        old.add_directory(root)
+        snapshot = os.path.join(self.work_dir, 'snapshot.bin')
+        old.save(snapshot, format='binary')
+        with open(os.path.join(root, 'c1', 's1', 't1mri', 'a1', 's1.nii'),
+                  'w') as f:
+            f.write('modified')
+        os.unlink(os.path.join(root, 'c1', 's1', 't1mri', 'a1', 's1.ima'))
+        os.makedirs(os.path.join(root, 'c1', 's4', 't1mri', 'a1'))
+        open(os.path.join(root, 'c1', 's4', 't1mri', 'a1', 's4.nii'),
+             'w').close()
+        new = fom.DirectoriesCache()
+        new.add_directory(root)
+        self.assertEqual(list(fom.DirectoriesCache.diff(new, new, root)), [])
+        self.assertEqual(old.digest(os.path.join(root, 'c2')),
+                         new.digest(os.path.join(root, 'c2')))
+        self.assertNotEqual(old.digest(root), new.digest(root))
+        expected = [
+            ('added', 'c1/s4'), ('added', 'c1/s4/t1mri'),
+            ('added', 'c1/s4/t1mri/a1'), ('added', 'c1/s4/t1mri/a1/s4.nii'),
+            ('modified', 'c1/s1/t1mri/a1/s1.nii'),
+            ('removed', 'c1/s1/t1mri/a1/s1.ima')]
+        for old_cache in (old, fom.DirectoriesCache.load(snapshot)):
+            changes = list(fom.DirectoriesCache.diff(old_cache, new, root))
+            self.assertEqual(sorted((change, '/'.join(path))
+                                    for change, path, st in changes),
+                             sorted(expected))
+        self.assertEqual(
+            sorted('/'.join(path) for path, st, attributes
+                   in pta.parse_directory(
+                       fom.DirectoriesCache.changes_to_dict(changes))),
+            ['c1/s1/t1mri/a1/s1.nii', 'c1/s4/t1mri/a1/s4.nii'])
+        # digests are saved in snapshots: identical subtrees of loaded
+        # snapshots are not read
+        json_snapshot = os.path.join(self.work_dir, 'snapshot.json')
+        old.save(json_snapshot)
+        self.assertEqual(fom.DirectoriesCache.load(json_snapshot).digests,
+                         old.digests)
+        new_snapshot = os.path.join(self.work_dir, 'new_snapshot.bin')
+        new.save(new_snapshot, format='binary')
+        listed = []
+        items = fom.DirectoryTree._items
+
+        def listing_items(tree, index):
+            listed.append(tree.path(index))
+            return items(tree, index)
+
+        fom.DirectoryTree._items = listing_items
+        try:
+            changes = list(fom.DirectoriesCache.diff(
+                fom.DirectoriesCache.load(snapshot),
+                fom.DirectoriesCache.load(new_snapshot), root))
+        finally:
+            fom.DirectoryTree._items = items
+        self.assertEqual(sorted((change, '/'.join(path))
+                                for change, path, st in changes),
+                         sorted(expected))
+        self.assertTrue(os.path.join(root, 'c1', 's1', 't1mri', 'a1')
+                        in listed)
+        self.assertFalse([path for path in listed
+                          if path.startswith(os.path.join(root, 'c2'))])
+        self.assertFalse([path for path in listed
+                          if path.startswith(os.path.join(root, 'c1', 's2'))])
+        # a nested cached directory changes the digest of its parents
+        digest = new.digest(root)
+        open(os.path.join(root, 'c2', 's3', 'new.txt'), 'w').close()
+        new.add_directory(os.path.join(root, 'c2'))
+        self.assertNotEqual(new.digest(root), digest)
+        self.assertEqual(
+            [(change, '/'.join(path)) for change, path, st
+             in fom.DirectoriesCache.diff(old, new, root)
+             if not path[0] == 'c1'],
+            [('added', 'c2/s3/new.txt')])
+        # digests are recomputed when the cache changes
+        new.remove_directory(os.path.join(root, 'c2'))
+        new.remove_directory(root)
+        self.assertEqual(new.digest(root), None)
+        self.assertEqual(
+            set(change for change, path, st
+                in fom.DirectoriesCache.diff(old, new, root)), {'removed'})
+
+    def test_directories_cache_refresh_digests(self):
+        root = os.path.join(self.work_dir, 'data')
+        for path in ('a/a1/f1', 'a/a2/f2', 'b/b1/f3'):
+            path = os.path.join(root, *path.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        old_time = time.time() - 100
+        for dirpath, dirnames, filenames in os.walk(root):
+            os.utime(dirpath, (old_time, old_time))
+        cache = fom.DirectoriesCache()
+        cache.add_directory(root)
+        snapshot = os.path.join(self.work_dir, 'snapshot.bin')
+        cache.save(snapshot, format='binary')
+        loaded = fom.DirectoriesCache.load(snapshot)
+        open(os.path.join(root, 'b', 'b1', 'f4'), 'w').close()
+        self.assertEqual(loaded.refresh()['listed'], 1)
+        # only the changed directory and its parents are hashed again
+        listed = []
+        items = fom.DirectoryTree._items
+
+        def listing_items(tree, index):
+            listed.append(tree.path(index))
+            return items(tree, index)
+
+        fom.DirectoryTree._items = listing_items
+        try:
+            digest = loaded.digest(root)
+        finally:
+            fom.DirectoryTree._items = items
+        self.assertEqual(listed, [])
+        cache.add_directory(root)
+        self.assertEqual(digest, cache.digest(root))
+        self.assertTrue(isinstance(loaded.get_directory(root)[1]['a'][1],
+                                   fom.DirectoryTreeNode))
+
+    def test_directory_tree_from_directory(self):
+        foms = fom.FileOrganizationModels()
+        foms.import_file(test_fom_definition)
+        pta = fom.PathToAttributes(foms)
+        root = os.path.join(self.work_dir, 'data')
+        for path in ('c1/s1/t1mri/a1/s1.nii.gz', 'c1/s1/t1mri/a1/s1.ima',
+                     'c1/s1/t1mri/a1/folds/Ls1.arg', 'c1/s1/other.txt',
+                     'c2/s2/t1mri/a1/s2.nii'):
+            path = os.path.join(root, *path.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(path)
+        os.mkdir(os.path.join(root, 'empty'))
+        dirdict = fom.DirectoryAsDict.get_directory(root)
+        tree = fom.DirectoryTree.from_directory(root)
+        content = tree.node(0)
+        self.assertEqual(tree.path(0), root)
+        self.assertTrue(isinstance(content, fom.DirectoryTreeNode))
+        self.assertEqual(sorted(content.keys()), ['c1', 'c2', 'empty'])
+        self.assertEqual(content['empty'][1].to_dict(), {})
+        self.assertEqual(
+            sorted(('/'.join(path), st[stat.ST_SIZE], attributes)
+                   for path, st, attributes
+                   in pta.parse_directory(content, all_unknown=True)),
+            sorted(('/'.join(path), st[stat.ST_SIZE], attributes)
+                   for path, st, attributes
+                   in pta.parse_directory(dirdict, all_unknown=True)))
+        statistics = fom.DirectoryAsDict.get_statistics(dirdict)
+        self.assertEqual(statistics[:3], (10, 5, 0))
+        self.assertEqual(fom.DirectoryAsDict.get_statistics(content),
+                         statistics)
+        tree = fom.DirectoryTree.from_directory(root, with_stat=False)
+        self.assertEqual(tree.stat(0), None)
+        self.assertEqual(
+            sorted('/'.join(path) for path, st, attributes
+                   in pta.parse_directory(tree.node(0))),
+            ['c1/s1/t1mri/a1/folds/Ls1.arg', 'c1/s1/t1mri/a1/s1.ima',
+             'c1/s1/t1mri/a1/s1.nii.gz', 'c2/s2/t1mri/a1/s2.nii'])
+
+    if not sys.platform.startswith('win'):
+
+        def test_parse_directory_parallel(self):
+            foms = fom.FileOrganizationModels()
+            foms.import_file(test_fom_definition)
+            pta = fom.PathToAttributes(foms)
+            paths = []
+            for center in ('c1', 'c2'):
+                for subject in ('s1', 's2', 's3'):
+                    paths += ['%s/%s/t1mri/a1/%s.nii' % (center, subject,
+                                                         subject),
+                              '%s/%s/t1mri/a1/folds/L%s.arg'
+                              % (center, subject, subject),
+                              '%s/%s/unknown.txt' % (center, subject)]
+            dirdict = fom.DirectoryAsDict.paths_to_dict(*paths)
+            expected = list(pta.parse_directory(dirdict, all_unknown=True))
+            for depth in (1, 3):
+                result = list(pta.parse_directory_parallel(
+                    dirdict, all_unknown=True, nworker=2, depth=depth))
+                self.assertEqual(result, expected)
+            result = list(pta.parse_directory_parallel(
+                dirdict, all_unknown=True, nworker=2, ordered=False))
+            self.assertEqual(sorted(result, key=repr),
+                             sorted(expected, key=repr))
+
+    def test_benchmark(self):
+        from soma.tests import fom_benchmark
+
+        for files, dotted in ((False, False), (True, False), (False, True)):
+            results = fom_benchmark.run_benchmark(
+                [(1, 2, 1), (2, 2, 2)], files=files, repeat=1,
+                work_directory=self.work_dir, dotted=dotted)
+            results = json.loads(json.dumps(results))
+            self.assertEqual(len(results['scales']), 2)
+            for result in results['scales']:
+                self.assertEqual(result['paths'],
+                                 13 * result['centers'] * result['subjects']
+                                 * result['acquisitions'])
+                self.assertEqual(result['find_paths_results'],
+                                 result['paths'])
+                self.assertEqual(result['parse_directory_results'],
+                                 result['paths'])
+
 
 def test():
     suite = unittest.TestLoader().loadTestsFromTestCase(TestFOM)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+
+from __future__ import absolute_import
+import unittest
+import shutil
+import os
+import tempfile
+import sys
+from soma import fom
+from soma.tests.test_fom import test_fom_definition
+
+
+class TestFomIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='soma_test_fom_index')
+        self.root = os.path.join(self.work_dir, 'data')
+        foms = fom.FileOrganizationModels()
+        foms.import_file(test_fom_definition)
+        self.pta = fom.PathToAttributes(foms)
+        self.create_files('c1/s1/t1mri/a1/s1.nii', 'c1/s1/t1mri/a1/s1.ima',
+                          'c1/s1/t1mri/a1/folds/Ls1.arg', 'c1/s2/raw/x.dcm')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def create_files(self, *paths):
+        for path in paths:
+            path = os.path.join(self.root, *path.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+
+    def parsed(self):
+        return sorted(('/'.join(path), sorted(attributes.items()))
+                      for path, st, attributes
+                      in self.pta.parse_filesystem(self.root))
+
+    @staticmethod
+    def indexed(index, **attributes):
+        return sorted((path, sorted(attributes.items()))
+                      for path, attributes in index.find(**attributes))
+
+    @unittest.skipUnless(sys.platform.startswith('linux'),
+                         'inotify is only available on Linux')
+    def test_live_index(self):
+        from soma.fom_index import FomLiveIndex
+
+        with FomLiveIndex(self.pta, self.root) as index:
+            self.assertEqual(self.indexed(index), self.parsed())
+            self.assertEqual(len(index), 3)
+            self.create_files('c1/s3/t1mri/a1/s3.nii.gz')
+            os.remove(os.path.join(self.root, 'c1', 's1', 't1mri', 'a1',
+                                   's1.ima'))
+            self.assertEqual(self.indexed(index), self.parsed())
+            self.assertEqual(
+                [path for path, attributes in index.find(subject='s3')],
+                ['c1/s3/t1mri/a1/s3.nii.gz'])
+            self.assertEqual(
+                index.attributes('c1/s3/t1mri/a1/s3.nii.gz')[0]['fom_format'],
+                'NIFTI gz')
+            os.rename(os.path.join(self.root, 'c1', 's1'),
+                      os.path.join(self.root, 'c1', 's4'))
+            self.assertEqual(self.indexed(index), self.parsed())
+            self.assertEqual(list(index.find(subject='s1')), [])
+            shutil.rmtree(os.path.join(self.root, 'c1', 's4'))
+            self.assertEqual(self.indexed(index), self.parsed())
+            self.assertEqual(len(index), 1)
+
+    def test_database(self):
+        from soma.fom_index import FomDatabase
+
+        filename = os.path.join(self.work_dir, 'index.sqlite')
+        with FomDatabase(filename) as db:
+            self.assertEqual(
+                db.update(self.pta.parse_filesystem(self.root)), 3)
+            self.assertEqual(self.indexed(db), self.parsed())
+        with FomDatabase(filename) as db:
+            self.assertEqual(self.indexed(db), self.parsed())
+            self.assertEqual(db.count(subject='s1'), 3)
+            self.assertEqual(db.count(subject='s2'), 0)
+            self.assertEqual(db.count(unknown_attribute='x'), 0)
+            self.assertEqual(
+                [path for path, attributes
+                 in db.find(fom_format=['NIFTI', 'Graph'], side='L')],
+                ['c1/s1/t1mri/a1/folds/Ls1.arg'])
+            self.assertEqual(db.attribute_values('fom_format'),
+                             ['GIS', 'Graph', 'NIFTI'])
+            path, st_mode, st_size, st_mtime = next(
+                db.find_stat(fom_format='NIFTI'))
+            self.assertEqual(st_size, 0)
+            # incremental update of a subtree
+            self.create_files('c1/s3/t1mri/a1/s3.nii.gz')
+            shutil.rmtree(os.path.join(self.root, 'c1', 's1'))
+            results = [(path, st, attributes)
+                       for path, st, attributes
+                       in self.pta.parse_filesystem(self.root)
+                       if path[0] == 'c1']
+            db.update(results, replace='c1')
+            self.assertEqual(self.indexed(db), self.parsed())
+            db.remove('c1/s3')
+            self.assertEqual(db.count(), 0)
+
+    def test_database_batches(self):
+        from soma.fom_index import FomDatabase
+
+        with FomDatabase() as db:
+            db.batch_size = 2
+            results = [(['a'], None, {'x': '0'}),
+                       (['b'], None, {'x': '1'}),
+                       (['b'], None, {'x': '2'}),
+                       (['c'], None, {'x': '3'})]
+            db.update([(['b'], None, {'x': 'old'})])
+            self.assertEqual(db.update(results), 4)
+            self.assertEqual(db.count(), 4)
+            self.assertEqual(sorted((path, attributes['x'])
+                                    for path, attributes in db.find()),
+                             [('a', '0'), ('b', '1'), ('b', '2'),
+                              ('c', '3')])
+
+
+def test():
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestFomIndex)
+    runtime = unittest.TextTestRunner(verbosity=2).run(suite)
+    return runtime.wasSuccessful()
+
+
+if __name__ == "__main__":
+    test()